@@ -4,13 +4,35 @@ import json
 import os
 import re
 import logging
+from collections import defaultdict
 from typing import List, Dict, Tuple, Any
 from utils.data_struct import MultiModalTurn, Table, Session, Conversation, ConversationDataset
 from utils.session_simulator import SessionSimulator
 from utils.prompt_templates import PERSONA
+from utils.json_utils import dump_json, loads_json
 
 logger = logging.getLogger(__name__)
 
+# 资金流向等宽表表头形如 "指标名[YYYYMMDD]"
+_FUND_FLOW_HEADER_RE = re.compile(r"(.*?)\[(\d{8})]")
+# Markdown 表格：表头行、分隔行、首个数据行和其余数据行
+_MARKDOWN_TABLE_RE = re.compile(r'\|(.+?)\|\n\|([\s\-:]+)\|(.+?)\n([\s\S]+?)(?=\n\n|\n###|$)', re.MULTILINE)
+# 带货币单位的数值（如 "12.5亿元"）和百分比（如 "-3.2%"）
+_CURRENCY_RE = re.compile(r'^(-?\d+(?:\.\d+)?)\s*(.*元)$')
+_PERCENTAGE_RE = re.compile(r"^(-?\d+(\.\d+)?)%$")
+# 货币单位换算，以“万元”为基准
+_UNIT_TO_WAN = {
+    "元": 1e-4,
+    "港元": 1e-4,
+    "美元": 8e-4,
+    "万元": 1.0,
+    "万港元": 1.0,
+    "万美元": 8.0,
+    "亿元": 1e4,
+    "亿港元": 1e4,
+    "亿美元": 8e4,
+}
+
 class BizFinLoader:
     def __init__(self, model:str, max_turns:int, is_step:bool, cache_dir: str,
                  combine_size = 10, generate_pseudo_dialogue=False,
@@ -181,8 +203,7 @@ class BizFinLoader:
         tables = []
         
         # 表格模式：匹配以 | 开头的行
-        table_pattern = r'\|(.+?)\|\n\|([\s\-:]+)\|(.+?)\n([\s\S]+?)(?=\n\n|\n###|$)'
-        matches = re.findall(table_pattern, text_content, re.MULTILINE)
+        matches = _MARKDOWN_TABLE_RE.findall(text_content)
         
         for match in matches:
             # 提取表头
@@ -208,9 +229,7 @@ class BizFinLoader:
         """
         将原始的宽格式表格转换为规范化的表格
         """
-        from collections import defaultdict
         metric_groups = defaultdict(list)
-        fund_flow_header_pattern = re.compile(r"(.*?)\[(\d{8})]")
         for raw_table in raw_table_objects:
             for row_dict in raw_table.rows:
                 stock_code = row_dict.get(self.col_mapping.get("code"))
@@ -227,7 +246,7 @@ class BizFinLoader:
                 stock_name_eng = self._reverse_map_sname(stock_name)
 
                 for header, value_str in row_dict.items():
-                    date_match = fund_flow_header_pattern.match(header)
+                    date_match = _FUND_FLOW_HEADER_RE.match(header)
                     if date_match:
                         chinese_metric = date_match.group(1)
                         date_str = date_match.group(2) 
@@ -282,10 +301,8 @@ class BizFinLoader:
             return value
 
         original_value_str = value.strip()
-        currency_pattern = re.compile(r'^(-?\d+(?:\.\d+)?)\s*(.*元)$')
-        percentage_pattern = re.compile(r"^(-?\d+(\.\d+)?)%$")
         # Handle percentage
-        percentage_match = percentage_pattern.match(original_value_str)
+        percentage_match = _PERCENTAGE_RE.match(original_value_str)
         if percentage_match:
             try:
                 return float(percentage_match.group(1)) / 100.0
@@ -294,25 +311,13 @@ class BizFinLoader:
                 return original_value_str
 
         # Handle currency
-        currency_match = currency_pattern.match(original_value_str)
+        currency_match = _CURRENCY_RE.match(original_value_str)
         if currency_match:
             try:
                 num_part = float(currency_match.group(1))
                 unit = currency_match.group(2)
-                # 以“万元”为基准做转换
-                unit_to_wan = {
-                    "元": 1e-4,
-                    "港元": 1e-4,
-                    "美元": 8e-4,
-                    "万元": 1.0,
-                    "万港元": 1.0,
-                    "万美元": 8.0,
-                    "亿元": 1e4,
-                    "亿港元": 1e4,
-                    "亿美元": 8e4,
-                }
-                if unit in unit_to_wan:
-                    return num_part * unit_to_wan[unit]
+                if unit in _UNIT_TO_WAN:
+                    return num_part * _UNIT_TO_WAN[unit]
                 else:
                     raise ValueError(f"Unsupported currency unit: {unit}")
             except ValueError as e:
@@ -367,7 +372,7 @@ class BizFinLoader:
             data_lines = []
             with open(file_path, 'r', encoding='utf-8') as f:
                 for line in f:
-                    data_lines.append(json.loads(line))
+                    data_lines.append(loads_json(line))
             
             # 处理每个样本，将它们组合成对话
             conversations = []
@@ -426,8 +431,7 @@ class BizFinLoader:
                 conv_data["sessions"].append(session_data)
             serialized.append(conv_data)
         
-        with open(output_path, 'w', encoding='utf-8') as f:
-            json.dump(serialized, f, indent=2, ensure_ascii=False)
+        dump_json(serialized, output_path)
         
 
 def main():
@@ -1,17 +1,10 @@
 import argparse
+import os
 import time
 from utils.logger import setup_logging
 from pipeline.med_loader.medical_preprocessor import MedicalPreprocessor
 from pipeline.med_loader.medical_dialogue_generator import MedicalDialogueGenerator
-import os
-import json
-import logging
-import pandas as pd
-from datetime import datetime, timedelta
-from typing import List, Dict, Tuple, Any
-from utils.data_struct import MultiModalTurn, Table, Session, Conversation, ConversationDataset
-from utils.session_simulator import SessionSimulator
-from utils.prompt_templates import PERSONA
+
 def main():
     # 设置日志
     timestamp = time.strftime("%Y%m%d_%H%M%S")
@@ -32,6 +25,8 @@ def main():
                                    help='每个会话的最大事件数')
     preprocess_parser.add_argument('--time_window', type=int, default=3,
                                    help='时间窗口大小（小时）')
+    preprocess_parser.add_argument('--max_patients', type=int, default=None,
+                                   help='最多处理的患者数（默认处理全部）')
     
     # 对话生成命令
     generate_parser = subparsers.add_parser('generate', help='生成伪对话')
@@ -56,7 +51,8 @@ def main():
             input_dir=args.input_dir,
             output_dir=args.output_dir,
             max_events_per_session=args.max_events,
-            time_window_hours=args.time_window
+            time_window_hours=args.time_window,
+            max_patients=args.max_patients
         )
         preprocessor.preprocess()
     
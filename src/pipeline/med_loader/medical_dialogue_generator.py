@@ -1,9 +1,10 @@
 import os
-import json
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Tuple, Any
 from utils.data_struct import MultiModalTurn, Table, Session, Conversation, ConversationDataset
 from utils.session_simulator import SessionSimulator
 from utils.prompt_templates import PERSONA
+from utils.json_utils import dump_json, iter_json_records
 
 import logging
 logger = logging.getLogger(__name__)
@@ -55,9 +56,16 @@ class MedicalDialogueGenerator:
             return
         
         # 为每个会话生成对话
-        for conversation in dataset.conversations:
-            for session in conversation.sessions:
-                self._generate_dialogue_for_session(session)
+        # LLM 调用期间在后台线程预取下一个会话的证据
+        sessions = [session for conversation in dataset.conversations for session in conversation.sessions]
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            next_future = None
+            for idx, session in enumerate(sessions):
+                future = next_future or executor.submit(self._tables_to_evidences, session.tables)
+                next_future = None
+                if idx + 1 < len(sessions):
+                    next_future = executor.submit(self._tables_to_evidences, sessions[idx + 1].tables)
+                self._generate_dialogue_for_session(session, future.result())
         
         # 保存最终数据集
         self._save_final_dataset(dataset)
@@ -65,17 +73,16 @@ class MedicalDialogueGenerator:
     
     def _load_preprocessed_data(self) -> ConversationDataset:
         """加载预处理数据"""
-        input_path = os.path.join(self.input_dir, "filtered_data.json")
-        if not os.path.exists(input_path):
-            logger.error(f"预处理数据文件不存在: {input_path}")
+        # 优先读取 JSON Lines 格式，兼容旧的 JSON 数组格式
+        candidates = [os.path.join(self.input_dir, name) for name in ("filtered_data.jsonl", "filtered_data.json")]
+        input_path = next((path for path in candidates if os.path.exists(path)), None)
+        if input_path is None:
+            logger.error(f"预处理数据文件不存在: {candidates}")
             return None
         
         try:
-            with open(input_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-            
             conversations = []
-            for conv_data in data:
+            for conv_data in iter_json_records(input_path):
                 sessions = []
                 for session_data in conv_data["sessions"]:
                     tables = []
@@ -108,12 +115,13 @@ class MedicalDialogueGenerator:
             logger.error(f"加载预处理数据时出错: {str(e)}")
             return None
     
-    def _generate_dialogue_for_session(self, session: Session):
-        """为会话生成伪对话"""
+    def _generate_dialogue_for_session(self, session: Session, evidences: List[Tuple] = None):
+        """为会话生成伪对话，evidences 为预取的证据（为空时现场从表格转换）"""
         logger.info(f"为会话 {session.id} 生成伪对话")
         
         # 将表格转换为证据
-        evidences = self._tables_to_evidences(session.tables)
+        if evidences is None:
+            evidences = self._tables_to_evidences(session.tables)
         
         if not evidences:
             logger.warning(f"会话 {session.id} 没有有效证据")
@@ -197,7 +205,6 @@ class MedicalDialogueGenerator:
                 conv_data["sessions"].append(session_data)
             serialized.append(conv_data)
         
-        with open(output_path, 'w', encoding='utf-8') as f:
-            json.dump(serialized, f, indent=2, ensure_ascii=False)
+        dump_json(serialized, output_path)
         
         logger.info(f"已保存最终数据集至: {output_path}")
\ No newline at end of file
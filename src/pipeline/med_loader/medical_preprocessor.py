@@ -1,17 +1,213 @@
 import os
-import json
 import logging
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import pandas as pd
 from datetime import datetime, timedelta
-from typing import List, Dict, Tuple, Any
+from typing import List, Dict, Tuple, Any, Optional
 from utils.data_struct import Table, Session, Conversation, ConversationDataset
+from utils.json_utils import dumps_json, dump_jsonl
+
+try:
+    from numba import njit
+except ImportError:  # numba is optional, the session scan then runs as plain Python
+    njit = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    from pyarrow import csv as pa_csv
+except ImportError:  # pyarrow is optional, CSV files are then read with pandas in chunks
+    pa = None
 
 logger = logging.getLogger(__name__)
 
+# Output columns for each medical table type
+_TABLE_HEADERS = {
+    'ChemistryEvents': ['PatientID', 'time_event', 'variable_name', 'value'],
+    'ABGEvents': ['PatientID', 'time_event', 'variable_name', 'value'],
+    'CultureEvents': ['PatientID', 'time_event', 'culture_source', 'value'],
+    'CBCEvents': ['PatientID', 'time_event', 'variable_name', 'value'],
+}
+
+# Raw CSV columns read for each table type
+_RAW_COLUMNS = {
+    'ChemistryEvents': ['PatientID', 'time_event', 'chem_name', 'value'],
+    'ABGEvents': ['PatientID', 'time_event', 'abg_ventilator_mode', 'abg_name', 'value'],
+    'CultureEvents': ['PatientID', 'time_event', 'culture_source', 'result'],
+    'CBCEvents': ['PatientID', 'time_event', 'cbc_name', 'value'],
+}
+# Raw name and value columns are always read as strings so chunks agree on dtype;
+# values are converted once per table after reading (see _convert_values)
+_RAW_DTYPES = {col: str for col in ('chem_name', 'abg_ventilator_mode', 'abg_name', 'culture_source', 'cbc_name',
+                                    'value', 'result')}
+# Rows per chunk when streaming raw CSV files
+_CSV_CHUNKSIZE = 200_000
+# Block size for the multi-threaded pyarrow CSV reader
+_ARROW_BLOCK_SIZE = 1 << 22
+
+def _assign_session_ids(patient_codes: np.ndarray, event_times: np.ndarray, window: int, max_events: int) -> np.ndarray:
+    """
+    Assign per-patient session ids to events sorted by patient and time.
+    Session ids restart from 0 for every patient. A new session starts when the
+    patient changes, an event falls after the current window end
+    (first event time + window) or the current session has max_events events.
+    """
+    session_ids = np.empty(len(event_times), dtype=np.int64)
+    session_id = -1
+    window_end = 0
+    count = 0
+    for i in range(len(event_times)):
+        if i == 0 or patient_codes[i] != patient_codes[i - 1]:
+            session_id = 0
+            window_end = event_times[i] + window
+            count = 0
+        elif event_times[i] > window_end or count >= max_events:
+            session_id += 1
+            window_end = event_times[i] + window
+            count = 0
+        session_ids[i] = session_id
+        count += 1
+    return session_ids
+
+if njit is not None:
+    _assign_session_ids = njit(cache=True)(_assign_session_ids)
+
+def _load_table(table_name: str, file_path: str):
+    """
+    Read a raw CSV file, map it to the unified event columns and add the table_type marker.
+    Returns an Arrow table when pyarrow is installed (multi-threaded reader),
+    otherwise a pandas DataFrame read in chunks. Timestamps and values are parsed per table
+    (formats and value types may differ between files), before the tables are merged.
+    Module-level so it can run in a worker process.
+    """
+    raw_columns = _RAW_COLUMNS.get(table_name)
+    if pa is not None:
+        table = _normalize_arrow_table(table_name, _read_csv_arrow(file_path, raw_columns))
+        table = _parse_arrow_columns(table)
+        # Dictionary-encode the marker: one shared string plus int32 codes
+        table_type = pa.DictionaryArray.from_arrays(
+            pa.array(np.zeros(table.num_rows, dtype=np.int32)), pa.array([table_name])
+        )
+        return table.append_column('table_type', table_type)
+    reader = pd.read_csv(
+        file_path,
+        chunksize=_CSV_CHUNKSIZE,
+        usecols=(lambda col: col in raw_columns) if raw_columns else None,
+        dtype=_RAW_DTYPES
+    )
+    chunks = [_normalize_chunk(table_name, chunk) for chunk in reader]
+    if not chunks:
+        return pd.DataFrame()
+    # Concatenate only once per table
+    df = pd.concat(chunks, ignore_index=True)
+    if 'value' in df.columns:
+        df['value'] = _convert_values(df['value'])
+    df = _parse_event_times(df)
+    df['table_type'] = table_name
+    return df
+
+def _read_csv_arrow(file_path: str, raw_columns: Optional[List[str]]) -> "pa.Table":
+    """Parse a whole CSV file with the multi-threaded pyarrow reader"""
+    # Timestamps stay strings and are parsed by pandas like in the chunked path
+    string_columns = [*_RAW_DTYPES, 'time_event']
+    return pa_csv.read_csv(
+        file_path,
+        read_options=pa_csv.ReadOptions(use_threads=True, block_size=_ARROW_BLOCK_SIZE),
+        convert_options=pa_csv.ConvertOptions(
+            include_columns=raw_columns,
+            column_types={col: pa.string() for col in string_columns},
+            strings_can_be_null=True
+        )
+    )
+
+def _normalize_arrow_table(table_name: str, table: "pa.Table") -> "pa.Table":
+    """Arrow counterpart of _normalize_chunk for table-specific columns"""
+    if table_name == 'ABGEvents':
+        variable_name = pc.binary_join_element_wise(table['abg_ventilator_mode'], table['abg_name'], '-')
+        table = table.drop_columns(['abg_ventilator_mode', 'abg_name']).append_column('variable_name', variable_name)
+    elif table_name == 'CultureEvents':
+        table = table.append_column('value', table['result'])
+    elif table_name == 'CBCEvents':
+        table = table.rename_columns({'cbc_name': 'variable_name'})
+    elif table_name == 'ChemistryEvents':
+        table = table.rename_columns({'chem_name': 'variable_name'})
+    # Low-cardinality names become dictionary columns, i.e. pandas categoricals after conversion
+    if 'variable_name' in table.column_names:
+        index = table.column_names.index('variable_name')
+        table = table.set_column(index, 'variable_name', pc.dictionary_encode(table['variable_name']))
+    return table
+
+def _parse_arrow_columns(table: "pa.Table") -> "pa.Table":
+    """Apply _convert_values and _parse_event_times to the string columns of an Arrow table"""
+    if 'value' in table.column_names:
+        index = table.column_names.index('value')
+        table = table.set_column(index, 'value', pa.array(_convert_values(table['value'].to_pandas()), from_pandas=True))
+    if 'time_event' in table.column_names:
+        times = _parse_event_times(pd.DataFrame({'time_event': table['time_event'].to_pandas()}))
+        index = table.column_names.index('time_event')
+        table = table.set_column(index, 'time_event', pa.array(times['time_event'], type=pa.string()))
+        table = table.append_column('time_event_dt', pa.array(times['time_event_dt'], type=pa.timestamp('ns')))
+    return table
+
+def _convert_values(values: pd.Series) -> pd.Series:
+    """
+    Convert a value column read as strings in one pass over the whole table, like
+    read_csv(low_memory=False) inferring the column: numbers if every value parses, otherwise strings
+    """
+    try:
+        return pd.to_numeric(values)
+    except (ValueError, TypeError):
+        return values
+
+def _normalize_chunk(table_name: str, df: pd.DataFrame) -> pd.DataFrame:
+    """Convert table-specific columns of a raw chunk"""
+    if table_name == 'ABGEvents':
+        df['variable_name'] = df['abg_ventilator_mode'] + '-' + df['abg_name']
+        df.drop(columns=['abg_ventilator_mode', 'abg_name'], inplace=True)
+    elif table_name == 'CultureEvents':
+        df['value'] = df['result']
+    elif table_name == 'CBCEvents':
+        df.rename(columns={'cbc_name': 'variable_name'}, inplace=True)
+    elif table_name == 'ChemistryEvents':
+        df.rename(columns={'chem_name': 'variable_name'}, inplace=True)
+    return df
+
+def _concat_tables(tables: list) -> pd.DataFrame:
+    """
+    Merge the loaded tables into one DataFrame.
+    Arrow tables are concatenated chunk-wise without copying and converted to pandas once.
+    Tables whose value columns have different types (numbers in one file, strings in another)
+    are converted separately and merged by pandas, keeping each table's values as they are.
+    """
+    if pa is not None and all(isinstance(table, pa.Table) for table in tables) and \
+            len({table.schema.field('value').type for table in tables if 'value' in table.column_names}) <= 1:
+        combined = pa.concat_tables(tables, promote_options="permissive")
+        # self_destruct frees each Arrow column as soon as pandas owns its copy
+        return combined.to_pandas(self_destruct=True, split_blocks=True)
+    return pd.concat([table.to_pandas() if pa is not None and isinstance(table, pa.Table) else table
+                      for table in tables], ignore_index=True)
+
+def _parse_event_times(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Parse the timestamps of one table; keep datetime for session splitting and string for output.
+    Called per table: to_datetime infers a single format from the column it is given.
+    """
+    if 'time_event' in df.columns:
+        df['time_event_dt'] = pd.to_datetime(
+            df['time_event'], 
+            errors='coerce'
+        )
+        # Convert timestamp to string format
+        df['time_event'] = df['time_event_dt'].dt.strftime('%Y-%m-%d %H:%M:%S').fillna("")
+    return df
+
 class MedicalPreprocessor:
     def __init__(self, input_dir: str, output_dir: str, 
                  max_events_per_session: int, 
-                 time_window_hours: int):
+                 time_window_hours: int,
+                 max_patients: Optional[int] = None):
         """
         Medical Data Preprocessor
         
@@ -20,11 +216,13 @@ class MedicalPreprocessor:
         output_dir: Path to processed output directory
         max_events_per_session: Maximum events per session
         time_window_hours: Time window size (hours)
+        max_patients: Maximum number of patients to process (None = all)
         """
         self.input_dir = input_dir
         self.output_dir = output_dir
         self.max_events_per_session = max_events_per_session
         self.time_window_hours = time_window_hours
+        self.max_patients = max_patients
         
         # Ensure output directory exists
         os.makedirs(self.output_dir, exist_ok=True)
@@ -39,128 +237,71 @@ class MedicalPreprocessor:
         """Preprocess medical data and save as intermediate format"""
         logger.info(f"Starting medical data preprocessing from: {self.input_dir}")
         
-        # 1. Read all table data
+        # 1. Read all table data, each file parsed in its own process
         all_data = {}
-        for table_name, filename in self.table_files.items():
-            file_path = os.path.join(self.input_dir, filename)
-            logger.info(f"Loading table: {table_name}, path: {file_path}")
+        futures = {}
+        with ProcessPoolExecutor(max_workers=len(self.table_files)) as pool:
+            for table_name, filename in self.table_files.items():
+                file_path = os.path.join(self.input_dir, filename)
+                logger.info(f"Loading table: {table_name}, path: {file_path}")
+                
+                if os.path.exists(file_path):
+                    futures[table_name] = pool.submit(_load_table, table_name, file_path)
+                else:
+                    logger.warning(f"File not found: {file_path}")
             
-            if os.path.exists(file_path):
+            for table_name, future in futures.items():
                 try:
-                    # Read CSV file, handle special values
-                    df = pd.read_csv(file_path, low_memory=False)
-                    
-                    # Convert timestamp to string during loading
-                    if 'time_event' in df.columns:
-                        df['time_event'] = pd.to_datetime(
-                            df['time_event'], 
-                            errors='coerce'
-                        )
-                        # Convert timestamp to string format
-                        df['time_event'] = df['time_event'].apply(
-                            lambda x: x.strftime('%Y-%m-%d %H:%M:%S') if not pd.isna(x) else ""
-                        )
-                    
-                    # Process specific table columns
-                    if table_name == 'ABGEvents':
-                        df['variable_name'] = df['abg_ventilator_mode'] + '-' + df['abg_name']
-                        df.drop(columns=['abg_ventilator_mode', 'abg_name'], inplace=True)
-                    elif table_name == 'CultureEvents':
-                        df['value'] = df['result']
-                    elif table_name == 'CBCEvents':
-                        df.rename(columns={'cbc_name': 'variable_name'}, inplace=True)
-                    elif table_name == 'ChemistryEvents':
-                        df.rename(columns={'chem_name': 'variable_name'}, inplace=True)
-                    
-                    # Add table type marker
-                    df['table_type'] = table_name
-                    all_data[table_name] = df
+                    all_data[table_name] = future.result()
                 except Exception as e:
                     logger.error(f"Error loading table {table_name}: {str(e)}")
-            else:
-                logger.warning(f"File not found: {file_path}")
         
         # 2. Merge all table data
-        combined_df = pd.concat(all_data.values(), ignore_index=True)
+        combined_df = _concat_tables(list(all_data.values()))
         logger.info(f"Merged data count: {len(combined_df)}")
         
+        # Store repeated string columns as categoricals so groupby works on integer codes.
+        # Columns already dictionary-encoded by Arrow keep their codes; categories are sorted
+        # so groupby order does not depend on the order values first appeared in.
+        for col in ('PatientID', 'table_type', 'variable_name'):
+            if col in combined_df.columns:
+                if isinstance(combined_df[col].dtype, pd.CategoricalDtype):
+                    combined_df[col] = combined_df[col].cat.reorder_categories(sorted(combined_df[col].cat.categories))
+                else:
+                    combined_df[col] = combined_df[col].astype('category')
+        
         # 3. Delete invalid time records
         combined_df = combined_df[combined_df['time_event'] != ""]
         logger.info(f"Valid events count: {len(combined_df)}")
         
-        # 4. Group by patient
-        grouped = combined_df.groupby('PatientID')
-        all_conversations = []
+        if self.max_patients is not None:
+            logger.warning(f"Patient limit active: only the first {self.max_patients} patients will be processed")
+            patient_ids = combined_df['PatientID'].cat.remove_unused_categories().cat.categories
+            combined_df = combined_df[combined_df['PatientID'].isin(patient_ids[:self.max_patients])]
         
-        # Create patient session index
-        patient_index = {}
+        # 4. Assign time-clustered sessions for all patients in one scan
+        events = self._assign_sessions(combined_df)
         
-        for i, (patient_id, patient_data) in enumerate(grouped):
-            if i >= 20:
-                break
-            logger.info(f"Processing patient: {patient_id}, events: {len(patient_data)}")
-            
-            # 5. Create time-clustered sessions for patient
-            sessions = self._create_sessions_for_patient(patient_id, patient_data)
-            
-            # Create session objects
-            session_objects = []
-            for session_idx, session_data in enumerate(sessions):
-                # Skip empty sessions
-                if session_data.empty:
-                    logger.warning(f"Session {session_idx+1} for patient {patient_id} is empty, skipping")
-                    continue
-                    
-                table_objects = self._create_table_objects(session_data)
-                
-                # Create Session object
-                session_id = f"patient_{patient_id}_session_{session_idx+1}"
-                
-                # Safely calculate time range
-                try:
-                    min_time = min(session_data['time_event'])
-                    max_time = max(session_data['time_event'])
-                    time_range_str = f"{min_time} to {max_time}"
-                except Exception as e:
-                    logger.error(f"Error calculating time range: {str(e)}")
-                    time_range_str = "Unknown time range"
-                
-                # Create empty dialogue turns (pseudo dialogue generated in next step)
-                turns = [
-                    {
-                        "turn_id": f"{session_id}_intro",
-                        "speaker": "System",
-                        "content": f"Session contains {len(session_data)} medical events",
-                        "mentioned_evidence": []
-                    }
-                ]
-                
-                session_objects.append(Session(
-                    session_id=session_id,
-                    time=time_range_str,
-                    participants=["User", "Assistant"],
-                    turns=turns,
-                    tables=table_objects
-                ))
-            
-            # Create Conversation object
-            conversation_id = f"patient_{patient_id}"
-            conversation = Conversation(
-                conversation_id=conversation_id,
-                speakers=["User", "Assistant"],
-                sessions=session_objects
-            )
-            
-            all_conversations.append(conversation)
-            patient_index[patient_id] = {
-                'num_sessions': len(session_objects),
-                'total_events': len(patient_data)
-            }
+        # 5. Split into (patient, session, table type) groups; groups arrive sorted by patient, then session
+        grouped = self._iter_table_groups(events)
+        all_conversations = []
         
-        # 6. Save index file
-        index_path = os.path.join(self.output_dir, "patient_index.json")
-        with open(index_path, 'w', encoding='utf-8') as f:
-            json.dump(patient_index, f, indent=2, ensure_ascii=False)
+        # Write patient session index one line per patient as each one finishes
+        index_path = os.path.join(self.output_dir, "patient_index.jsonl")
+        with open(index_path, 'w', encoding='utf-8') as index_f:
+            for patient_id, patient_groups in itertools.groupby(grouped, key=lambda item: item[0][0]):
+                conversation, total_events = self._create_conversation_for_patient(patient_id, patient_groups)
+                all_conversations.append(conversation)
+                logger.info(f"Processed patient: {patient_id}, events: {total_events}, sessions: {len(conversation.sessions)}")
+                
+                # 6. Append index entry
+                index_entry = {
+                    'PatientID': str(patient_id),
+                    'num_sessions': len(conversation.sessions),
+                    'total_events': total_events
+                }
+                index_f.write(dumps_json(index_entry) + "\n")
+                index_f.flush()
         logger.info(f"Saved patient index file: {index_path}")
         
         # 7. Create and save dataset
@@ -169,126 +310,154 @@ class MedicalPreprocessor:
         logger.info(f"Data preprocessing complete, generated: {len(all_conversations)} conversations")
         return dataset
     
-    def _save_preprocessed_data(self, dataset: ConversationDataset):
-        """Save preprocessed data"""
-        output_path = os.path.join(self.output_dir, "preprocessed_data.json")
-        
-        serialized = []
-        for conversation in dataset.conversations:
-            conv_data = {
-                "conversation_id": conversation.id,
-                "speakers": conversation.speakers,
-                "sessions": []
-            }
-            for session in conversation.sessions:
-                session_data = {
-                    "session_id": session.id,
-                    "time": session.time,
-                    "participants": session.participants,
-                    "turns": session.turns,
-                    "tables": []
+    def _create_conversation_for_patient(self, patient_id: str, patient_groups) -> Tuple[Conversation, int]:
+        """
+        Create a Conversation of time-clustered sessions for a single patient.
+        patient_groups yields ((PatientID, session_idx, table_type), DataFrame) items of
+        this patient in session order. Returns the conversation and its event count.
+        """
+        session_objects = []
+        total_events = 0
+        for session_idx, session_groups in itertools.groupby(patient_groups, key=lambda item: item[0][1]):
+            table_groups = [(key[2], group) for key, group in session_groups]
+            table_objects = [self._create_table_object(table_type, group) for table_type, group in table_groups]
+            num_events = sum(len(group) for _, group in table_groups)
+            total_events += num_events
+            
+            # Create Session object
+            session_id = f"patient_{patient_id}_session_{session_idx+1}"
+            
+            # Rows of every group are time-sorted, so first/last rows bound the session
+            min_time = min(group['time_event'].iat[0] for _, group in table_groups)
+            max_time = max(group['time_event'].iat[-1] for _, group in table_groups)
+            time_range_str = f"{min_time} to {max_time}"
+            
+            # Create empty dialogue turns (pseudo dialogue generated in next step)
+            turns = [
+                {
+                    "turn_id": f"{session_id}_intro",
+                    "speaker": "System",
+                    "content": f"Session contains {num_events} medical events",
+                    "mentioned_evidence": []
                 }
-                
-                # Process table data
-                for table in session.tables:
-                    table_data = {
-                        "headers": table.headers,
-                        "rows": table.rows,
-                        "table_type": getattr(table, 'table_type', 'Unknown')
-                    }
-                    session_data["tables"].append(table_data)
-                
-                conv_data["sessions"].append(session_data)
-            serialized.append(conv_data)
+            ]
+            
+            session_objects.append(Session(
+                session_id=session_id,
+                time=time_range_str,
+                participants=["User", "Assistant"],
+                turns=turns,
+                tables=table_objects
+            ))
         
-        with open(output_path, 'w', encoding='utf-8') as f:
-            json.dump(serialized, f, indent=2, ensure_ascii=False)
+        # Create Conversation object
+        conversation_id = f"patient_{patient_id}"
+        conversation = Conversation(
+            conversation_id=conversation_id,
+            speakers=["User", "Assistant"],
+            sessions=session_objects
+        )
+        return conversation, total_events
+    
+    def _save_preprocessed_data(self, dataset: ConversationDataset):
+        """Save preprocessed data as JSON Lines, one conversation per line"""
+        output_path = os.path.join(self.output_dir, "preprocessed_data.jsonl")
+        dump_jsonl((self._serialize_conversation(conversation) for conversation in dataset.conversations), output_path)
         
         logger.info(f"Saved preprocessed data to: {output_path}")
     
-    def _create_sessions_for_patient(self, patient_id: str, patient_data: pd.DataFrame) -> List[pd.DataFrame]:
-        """Create time-clustered sessions for a single patient"""
-        # Since timestamps are strings, convert to datetime for time calculations
-        patient_data = patient_data.copy()
-        patient_data['time_event_dt'] = pd.to_datetime(patient_data['time_event'], errors='coerce')
-        patient_data = patient_data.dropna(subset=['time_event_dt'])
-        
-        # Sort events by time
-        sorted_events = patient_data.sort_values('time_event_dt').reset_index(drop=True)
-        
-        sessions = []
-        current_session = []
-        current_window_end = None
-        
-        for idx, event in sorted_events.iterrows():
-            event_time = event['time_event_dt']
+    def _serialize_conversation(self, conversation: Conversation) -> Dict:
+        """Convert a Conversation into its JSON-serializable form"""
+        conv_data = {
+            "conversation_id": conversation.id,
+            "speakers": conversation.speakers,
+            "sessions": []
+        }
+        for session in conversation.sessions:
+            session_data = {
+                "session_id": session.id,
+                "time": session.time,
+                "participants": session.participants,
+                "turns": session.turns,
+                "tables": []
+            }
             
-            # If first event
-            if not current_session:
-                current_session.append(event)
-                current_window_end = event_time + timedelta(hours=self.time_window_hours)
-                continue
+            # Process table data
+            for table in session.tables:
+                table_data = {
+                    "headers": table.headers,
+                    "rows": table.rows,
+                    "table_type": getattr(table, 'table_type', 'Unknown')
+                }
+                session_data["tables"].append(table_data)
             
-            # Check if event is within time window and hasn't reached max count
-            if (event_time <= current_window_end) and (len(current_session) < self.max_events_per_session):
-                current_session.append(event)
-            else:
-                # Save current session and start new one
-                if current_session:  # Ensure session is not empty
-                    # Remove temporary datetime column
-                    session_df = pd.DataFrame(current_session).drop(columns=['time_event_dt'])
-                    sessions.append(session_df)
-                current_session = [event]
-                current_window_end = event_time + timedelta(hours=self.time_window_hours)
+            conv_data["sessions"].append(session_data)
+        return conv_data
+    
+    def _assign_sessions(self, events: pd.DataFrame) -> pd.DataFrame:
+        """Sort events by patient and time and add a per-patient session_idx column"""
+        # Use the datetime column parsed during loading for time calculations
+        events = events.dropna(subset=['time_event_dt'])
+        
+        # Stable sort keeps the load order of events sharing a timestamp
+        events = events.sort_values(['PatientID', 'time_event_dt'], kind='stable').reset_index(drop=True)
         
-        # Add last session
-        if current_session:
-            session_df = pd.DataFrame(current_session).drop(columns=['time_event_dt'])
-            sessions.append(session_df)
+        # Assign a session id to every event in a single scan over int64 timestamps
+        patient_codes = events['PatientID'].cat.codes.to_numpy(dtype=np.int64)
+        event_times = events['time_event_dt'].to_numpy(dtype='datetime64[ns]').view('int64')
+        window_ns = int(timedelta(hours=self.time_window_hours).total_seconds() * 1e9)
+        session_ids = _assign_session_ids(patient_codes, event_times, window_ns, self.max_events_per_session)
         
-        logger.info(f"Patient {patient_id} divided into {len(sessions)} sessions")
-        return sessions
+        # Remove temporary datetime column
+        events = events.drop(columns=['time_event_dt'])
+        events['session_idx'] = session_ids
+        return events
     
-    def _create_table_objects(self, session_data: pd.DataFrame) -> List[Table]:
-        """Create Table objects from session data"""
-        if session_data.empty:
-            return []
+    def _iter_table_groups(self, events: pd.DataFrame):
+        """
+        Yield ((PatientID, session_idx, table_type), DataFrame) for every table of every session.
+        Events are ordered once so that each group is a contiguous row range and is taken
+        as an iloc slice instead of going through a groupby hash table.
+        """
+        patient_codes = events['PatientID'].cat.codes.to_numpy()
+        session_ids = events['session_idx'].to_numpy()
+        table_codes = events['table_type'].cat.codes.to_numpy()
+        # lexsort is stable, so events keep their time order inside each group
+        order = np.lexsort((table_codes, session_ids, patient_codes))
+        events = events.iloc[order]
+        patient_codes, session_ids, table_codes = patient_codes[order], session_ids[order], table_codes[order]
         
-        # Group by table type
-        table_objects = []
-        for table_type, group in session_data.groupby('table_type'):
-            # Create appropriate column names
-            if table_type == 'ChemistryEvents':
-                headers = ['PatientID', 'time_event', 'variable_name', 'value']
-                # Check if columns exist
-                available_headers = [col for col in headers if col in group.columns]
-                # Remove rows with NaN values
-                cleaned_group = group[available_headers].dropna()
-                rows = cleaned_group.to_dict('records')
-            elif table_type == 'ABGEvents':
-                headers = ['PatientID', 'time_event', 'variable_name', 'value']
-                available_headers = [col for col in headers if col in group.columns]
-                cleaned_group = group[available_headers].dropna()
-                rows = cleaned_group.to_dict('records')
-            elif table_type == 'CultureEvents':
-                headers = ['PatientID', 'time_event', 'culture_source', 'value']
-                available_headers = [col for col in headers if col in group.columns]
-                cleaned_group = group[available_headers].dropna()
-                rows = cleaned_group.to_dict('records')
-            elif table_type == 'CBCEvents':
-                headers = ['PatientID', 'time_event', 'variable_name', 'value']
-                available_headers = [col for col in headers if col in group.columns]
-                cleaned_group = group[available_headers].dropna()
-                rows = cleaned_group.to_dict('records')
-            else:
-                # Default handling
-                headers = list(group.columns)
-                cleaned_group = group.dropna()
-                rows = cleaned_group.to_dict('records')
-            
-            # Create table with additional metadata
-            table = Table(headers=available_headers, rows=rows)
-            table.table_type = table_type  # Add table type as attribute
-            table_objects.append(table)
+        boundaries = np.flatnonzero(
+            (patient_codes[1:] != patient_codes[:-1])
+            | (session_ids[1:] != session_ids[:-1])
+            | (table_codes[1:] != table_codes[:-1])
+        ) + 1
+        starts = np.concatenate(([0], boundaries))
+        ends = np.concatenate((boundaries, [len(events)]))
+        patient_values = events['PatientID'].cat.categories
+        table_values = events['table_type'].cat.categories
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            if start == end:
+                continue
+            key = (patient_values[patient_codes[start]], int(session_ids[start]), table_values[table_codes[start]])
+            yield key, events.iloc[start:end]
+    
+    def _create_table_object(self, table_type: str, group: pd.DataFrame) -> Table:
+        """Create a Table object from the events of one table type in a session"""
+        # Pick column names for this table type, default to all columns
+        headers = _TABLE_HEADERS.get(table_type, [col for col in group.columns if col != 'session_idx'])
+        # Check if columns exist
+        available_headers = [col for col in headers if col in group.columns]
+        # Remove rows with NaN values: one null mask over the selected columns instead of a dropna copy
+        columns = [group[col].to_numpy() for col in available_headers]
+        keep = np.logical_and.reduce([pd.notna(values) for values in columns]) if columns else None
+        if keep is not None and not keep.all():
+            columns = [values[keep] for values in columns]
+        # Zip plain Python column lists; much cheaper than to_dict('records') for many small groups
+        rows = [dict(zip(available_headers, values))
+                for values in zip(*(values.tolist() for values in columns))]
         
-        return table_objects
\ No newline at end of file
+        # Create table with additional metadata
+        table = Table(headers=available_headers, rows=rows)
+        table.table_type = table_type  # Add table type as attribute
+        return table
@@ -1,11 +1,22 @@
 import os
 import re
-import json
+import atexit
+import gc
+import math
 import time
+import hashlib
 import random
+import shutil
 import logging
+import threading
 import argparse
-from typing import Any, List, Dict, Literal, Tuple, Union
+from collections import ChainMap, Counter, OrderedDict, deque
+from functools import lru_cache
+from itertools import groupby, repeat
+from operator import itemgetter
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Any, List, Dict, Literal, Tuple, Union, get_args
+from openai import APIConnectionError, APITimeoutError, RateLimitError
 
 from utils.params import get_base_parser, qa_generation_args
 from utils.logger import setup_logging
@@ -13,9 +24,254 @@ from utils.prompt_templates import QA_GENERATION_PROMPTS, SYSTEM_PROMPTS
 from client.llm_client import client
 from utils.data_struct import MultiModalTurn, Table, Session, Conversation, ConversationDataset, load_data, save_results
 from utils.cache_manager import QACacheManager, DifficultyLevel
+from utils.json_utils import dump_json, dumps_json, load_json, loads_json
+from utils.llm_cache import LLMResponseCache
+from utils.rate_limiter import RateLimiter, AdaptiveConcurrencyLimiter, retry_with_backoff
 from utils.sql_engine import SqlEngine
 from utils.validator import Validator
 
+# 限流和网络类错误可重试，其余错误（如参数错误）直接抛出
+_RETRYABLE_API_ERRORS = (RateLimitError, APIConnectionError, APITimeoutError)
+# Section 1: Crucial Instructions (Prioritize Uniqueness and Diversity)
+# 所有调用都相同，放在 system 消息中，使请求的固定前缀尽可能长，便于服务端前缀缓存
+_GENERATION_GUIDELINES = (
+    "### IMPORTANT GENERATION GUIDELINES:\n"
+    "Your primary goal is to generate a **NEW, UNIQUE, and SEMANTICALLY DISTINCT question** based on the provided context.\n"
+    "**DO NOT** merely rephrase or slightly alter any existing question. Strive for **stylistic and semantic diversity**.\n"
+    "Explore different facts, aspects, or aggregation types within the context to formulate truly novel questions.\n"
+    "The question must be answerable solely from the provided context.\n\n"
+)
+# 示例指导文本缓存的最大条目数（示例池较大、组合很多时整体清空）
+_GUIDANCE_CACHE_SIZE = 1024
+# 提前结束流式回复时（拿不到 usage）按字符数估算 token 数
+_CHARS_PER_TOKEN = 4
+# 难度越高，回复越长、生成越慢
+_DIFFICULTY_RANK = {"easy": 0, "medium": 1, "hard": 2}
+# 一次采样中未缓存的会话达到该数量时才使用进程池并行渲染，数量少时进程间传输的开销大于收益
+_PARALLEL_RENDER_MIN_SESSIONS = 8
+# 预先填充模板时会话上下文的占位符（提示词模板中不会出现的字符）
+_CONTEXT_PLACEHOLDER = "\0"
+# context_last 时模板中会话上下文原位置的说明文字，以及移到提示词末尾的上下文标题
+_CONTEXT_POINTER = "(The session context is given at the end of this message, after the rules.)"
+_TRAILING_CONTEXT_HEADER = "\n\n### Session Context\n"
+# samples_per_request 为 0（自动）时单次请求的最大采样数（DashScope 兼容接口的 n 最大为 4）
+_MAX_AUTO_SAMPLES = 4
+# 会话 id 末尾的编号（如 "patient_1_session_10" 中的 10）
+_SESSION_NUMBER_RE = re.compile(r"(\d+)\D*$")
+# 从文本形式的答案中提取第一个数值
+_ANSWER_NUMBER_RE = re.compile(r"-?\d+(?:\.\d+)?")
+# 校验阶段解析LLM返回的双查询（SQL_ANSWER / SQL_EVIDENCE）及去除 Markdown 代码块标记
+_SQL_ANSWER_RE = re.compile(r'SQL_ANSWER:\s*(.*?)(?=SQL_EVIDENCE:|$)', re.DOTALL | re.IGNORECASE)
+_SQL_EVIDENCE_RE = re.compile(r'SQL_EVIDENCE:\s*(.*)', re.DOTALL | re.IGNORECASE)
+_SQL_FENCE_RE = re.compile(r'^\s*```(?:sql)?\s*|\s*```\s*$', re.IGNORECASE)
+# validate_and_correct 返回结果的初始字段（按此顺序写入缓存的 sql_info）
+_SQL_RESULT_TEMPLATE = {
+    "sql_status": None,
+    "sql_answer_query": None,
+    "sql_evidence_query": None,
+    "sql_answer": None,
+    "sql_evidence": None,
+    "error": None
+}
+# 每个校验线程的内存库中最多保留的已建表数
+_SQL_TABLE_CACHE_SIZE = 32
+# 校验阶段生成SQL的提示模板，按领域区分；未知领域使用通用模板
+_SQL_PROMPT_TEMPLATES = {
+    "financial": """
+            ### Financial SQL Generation
+            You are a financial SQL expert. Generate two SQL queries for the following question:
+            Question: {question}
+            
+            Database Schema:
+            Table: unified_data
+            Columns: code (TEXT), sname (TEXT), tdate (TEXT), value (REAL), metric (TEXT)
+            
+            Requirements:
+            1. First query (SQL_ANSWER): Calculate the answer to the question.
+            2. Second query (SQL_EVIDENCE): Retrieve all evidence rows used in the calculation.
+            3. Output both queries in the format:
+                SQL_ANSWER: [query];
+                SQL_EVIDENCE: [query];
+            """,
+    "medical": """
+            ### Medical SQL Generation
+            You are a medical SQL expert. Generate two SQL queries for the following question:
+            Question: {question}
+            
+            Database Schema:
+            Table: unified_data
+            Columns: PatientID (TEXT), time_event (TEXT), variable_name (TEXT), value (REAL), table_type (TEXT)
+            
+            Requirements:
+            1. First query (SQL_ANSWER): Calculate the answer to the question.
+            2. Second query (SQL_EVIDENCE): Retrieve all evidence rows used in the calculation.
+            3. Output both queries in the format:
+                SQL_ANSWER: [query];
+                SQL_EVIDENCE: [query];
+            """,
+}
+_GENERIC_SQL_PROMPT_TEMPLATE = """
+            ### Generic SQL Generation
+            Generate two SQL queries for the following question:
+            Question: {question}
+            
+            Database Schema:
+            Table: unified_data
+            Columns: entity_id (TEXT), timestamp (TEXT), variable_name (TEXT), value (REAL), table_type (TEXT)
+            
+            Requirements:
+            1. First query (SQL_ANSWER): Calculate the answer to the question.
+            2. Second query (SQL_EVIDENCE): Retrieve all evidence rows used in the calculation.
+            3. Output both queries in the format:
+                SQL_ANSWER: [query];
+                SQL_EVIDENCE: [query];
+            """
+
+
+def _row_template(headers: List[str], extra_fields: Dict | None) -> Tuple[Tuple, str | None]:
+    """
+    为表格预先构建行格式模板，返回 (表头键元组, 模板)。
+    模板形如 "  Row %d: h1: %s, h2: %s\n"，附加字段直接写入模板末尾；
+    附加字段与表头重名（需要覆盖行内的值）或没有表头时返回 None，由调用方逐字段拼接。
+    """
+    header_keys = tuple(headers)
+    if not header_keys or (extra_fields and not extra_fields.keys().isdisjoint(header_keys)):
+        return header_keys, None
+    fields = [str(h).replace("%", "%%") + ": %s" for h in header_keys]
+    if extra_fields:
+        fields.extend(f"{k}: {v}".replace("%", "%%") for k, v in extra_fields.items())
+    return header_keys, "  Row %d: " + ", ".join(fields) + "\n"
+
+
+@lru_cache(maxsize=None)
+def _session_id_sort_key(session_id: str) -> Tuple[int, int, str]:
+    """会话 id 的排序键：按 id 中最后一段数字的数值排序（session_2 在 session_10 之前），没有数字的排在最后"""
+    match = _SESSION_NUMBER_RE.search(session_id)
+    if match is None:
+        return 1, 0, session_id
+    return 0, int(match.group(1)), session_id
+
+
+def _session_sort_key(session: Session) -> Tuple[int, int, str]:
+    """会话的排序键，提示词中的会话按此顺序排列（即会话的时间顺序）"""
+    return _session_id_sort_key(session.id)
+
+
+def _render_row(row_idx: int, row: Dict, extra_fields: Dict | None) -> str:
+    """逐字段拼接一行（行的键与表头不一致，或无法使用行模板时）"""
+    items = {**row, **extra_fields}.items() if extra_fields else row.items()
+    return f"  Row {row_idx}: " + ", ".join([f"{k}: {v}" for k, v in items]) + "\n"
+
+
+def _render_session_text(session: Session, is_medical: bool, table_type_in_header: bool = False) -> str:
+    """
+    渲染单个会话的上下文文本。
+    纯函数且参数可序列化，可以直接提交到进程池并行执行（见 QuestionGenerator._build_session_context）。
+    table_type_in_header 为 True 时，医疗领域的表格类型只在表头行写一次，不再附加到每一行。
+    """
+    # 各片段先收集到列表，最后一次性拼接，避免字符串 += 的二次复制
+    parts = [f"### Session ID: {session.id}\n"]
+    if session.tables:
+        parts.append("Data Type: Structured Table\n")
+        for idx, table in enumerate(session.tables):
+            # 领域相关的处理按表决定一次，不在每一行重复判断
+            # 医疗领域附加表格类型：写在表头行，或附加到每行数据之后（使用副本，不修改共享的数据集行，并发生成时也安全）
+            extra_fields = {'table_type': getattr(table, 'table_type', 'Unknown')} if is_medical else None
+            if extra_fields and table_type_in_header:
+                parts.append(f"Table {idx} (Headers: {', '.join(table.headers)}; table_type: {extra_fields['table_type']}):\n")
+                extra_fields = None
+            else:
+                parts.append(f"Table {idx} (Headers: {', '.join(table.headers)}):\n")
+            header_keys, row_template = _row_template(table.headers, extra_fields)
+            rows = table.rows
+            if row_template is not None and all(map(header_keys.__eq__, map(tuple, rows))):
+                # 所有行的键都与表头一致（常见情况）：把行号和各行的值展开成一个元组，整张表只做一次 % 格式化
+                values = []
+                for row_idx, row in enumerate(rows):
+                    values.append(row_idx)
+                    values.extend(row.values())
+                parts.append((row_template * len(rows)) % tuple(values))
+                continue
+            for row_idx, row in enumerate(rows):
+                # 键与表头完全一致（常见情况）时一次 % 格式化整行，否则逐个字段拼接
+                if row_template is not None and tuple(row) == header_keys:
+                    parts.append(row_template % (row_idx, *row.values()))
+                else:
+                    parts.append(_render_row(row_idx, row, extra_fields))
+    else:
+        parts.append(f"Time: {session.time}\nParticipants: {', '.join(session.participants)}\nDialogs:\n")
+        # 对话轮次用一次列表推导生成，再整体加入 parts
+        parts.extend([f"Turn {turn.id}: {turn.speaker}: {turn.content}\n" for turn in session.turns])
+    parts.append("\n")
+    return "".join(parts)
+
+
+class _JsonEndDetector:
+    """
+    跟踪流式回复中顶层 JSON 对象的括号深度（字符串内的括号和转义字符不计），
+    包含 "question" 键的对象闭合后 done 为 True，[start, end) 为该对象在已输入文本中的位置。
+    模型在 JSON 之前写的说明文字中出现的其他 {...} 闭合时不算结束，继续跟踪之后的对象。
+    """
+    __slots__ = ("depth", "in_string", "escaped", "done", "key", "after_key", "has_question",
+                 "offset", "start", "end")
+
+    def __init__(self):
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.done = False
+        self.key: List[str] | None = None  # 正在读取的顶层字符串（可能是键）
+        self.after_key = False  # 刚读完的顶层字符串是 "question"，后面紧跟冒号时即为该键
+        self.has_question = False  # 当前顶层对象是否已出现 "question" 键
+        self.offset = 0  # 之前输入的字符数
+        self.start = self.end = -1
+
+    def feed(self, text: str):
+        if self.done:
+            return
+        for i, char in enumerate(text):
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                    if self.key is not None:
+                        self.key.append(char)
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+                    if self.key is not None:
+                        self.after_key = "".join(self.key) == "question"
+                        self.key = None
+                elif self.key is not None:
+                    self.key.append(char)
+                continue
+            if self.after_key and not char.isspace():
+                self.after_key = False
+                if char == ":":
+                    self.has_question = True
+                    continue
+            if char == '"':
+                self.in_string = self.depth > 0
+                self.key = [] if self.depth == 1 else None
+            elif char == "{":
+                if self.depth == 0:
+                    self.start = self.offset + i
+                self.depth += 1
+            elif char == "}" and self.depth > 0:
+                self.depth -= 1
+                if self.depth == 0 and self.has_question:
+                    self.done = True
+                    self.end = self.offset + i + 1
+                    return
+        self.offset += len(text)
+
+
+def _generate_partition(generator_kwargs: Dict, dataset: ConversationDataset,
+                        difficulty_counts: Dict[DifficultyLevel, int]):
+    """多进程生成的子进程入口：用给定参数创建生成器并为分到的对话生成QA（结果只写入其缓存目录）"""
+    QuestionGenerator(**generator_kwargs).batch_generate(dataset, difficulty_counts)
+
+
 class QuestionGenerator:
     def __init__(self, model: str,
                  min_sessions=5, max_sessions=10,
@@ -24,8 +280,33 @@ class QuestionGenerator:
                  cache_dir: str = "./qa_generation_cache", is_step=False,
                  max_preferred_examples: int = 3,
                  max_disliked_examples: int = 3,
-                 domain: str = "medical"):
+                 domain: str = "medical",
+                 max_concurrency: int = 8,
+                 qpm: int = 0,
+                 tpm: int = 0,
+                 use_prompt_cache_key: bool = False,
+                 save_every: int = 10,
+                 use_batch_api: bool = False,
+                 batch_poll_interval: float = 60.0,
+                 render_workers: int = 0,
+                 enable_thinking: bool = True,
+                 seed: int | None = None,
+                 num_workers: int = 1,
+                 use_response_cache: bool = False,
+                 table_type_in_header: bool = False,
+                 temperature: float | None = None,
+                 response_cache_match: Literal["exact", "context"] = "exact",
+                 context_last: bool = False,
+                 samples_per_request: int = 1,
+                 append_cache_log: bool = False,
+                 cache_format: Literal["json", "jsonl"] = "json",
+                 request_timeout: float | None = None,
+                 model_by_difficulty: Dict[DifficultyLevel, str] | None = None):
+        # 构造参数，多进程生成时用于在子进程中创建相同配置的生成器
+        self._init_kwargs = {k: v for k, v in locals().items() if k != "self"}
         self.model = model
+        # 按难度指定生成模型（如简单题使用更小更快的模型），未指定的难度使用 model
+        self.model_by_difficulty = {d: m for d, m in (model_by_difficulty or {}).items() if m}
         self.min_sessions = min_sessions
         self.max_sessions = max_sessions
         self.session_threshold = session_threshold
@@ -33,94 +314,628 @@ class QuestionGenerator:
         self.max_evidences = max_evidences
         self.logger = logging.getLogger(self.__class__.__name__)
         self.difficulty: DifficultyLevel = "easy"
-        self.cache_manager = QACacheManager(cache_dir) # init includes loading cache
+        self.cache_manager = QACacheManager(cache_dir, append_log=append_cache_log, cache_format=cache_format) # init includes loading cache
         self.is_step = is_step
         self.max_preferred_examples = max_preferred_examples
         self.max_disliked_examples = max_disliked_examples
         self.domain = domain  # 添加领域标识
+        self.max_concurrency = max(1, max_concurrency)  # 非逐步模式下的最大并发LLM请求数
+        # 所有LLM请求共享的每分钟请求数 / token 数限制（0 表示不限）
+        self.rate_limiter = RateLimiter(qpm, tpm)
+        # AIMD 并发上限：被限流时减半，持续成功后逐步恢复到 max_concurrency
+        self.concurrency_limiter = AdaptiveConcurrencyLimiter(self.max_concurrency)
+        # 生成请求的重试统一由 retry_with_backoff 负责：关闭 SDK 内部的自动重试，
+        # 避免并发请求被限流时在限制器之外立即重发，每次 429 都能让并发上限及时减半
+        # request_timeout 限制单次请求的连接和读取等待时间（流式调用时为两个分片之间的间隔），
+        # 卡住的连接超时后由 retry_with_backoff 重发，不再长时间占用一个并发槽位
+        client_options = {"max_retries": 0}
+        if request_timeout:
+            client_options["timeout"] = request_timeout
+        self._client = client.with_options(**client_options)
+        self.use_prompt_cache_key = use_prompt_cache_key  # 是否在请求中附带 prompt_cache_key
+        # 是否开启深度思考；开启时只能流式调用，关闭时使用非流式调用
+        self.enable_thinking = enable_thinking
+        # 采样温度（None 表示使用服务端默认值）；为 0 时相同请求的回复相同，进行中的相同请求合并为一次调用
+        self.temperature = temperature
+        self._inflight: Dict[str | bytes, Future] = {}  # 请求键 -> 进行中的请求
+        self._inflight_lock = threading.Lock()
+        # 提示词中不随调用变化的部分，初始化时准备一次
+        self._system_prompt = SYSTEM_PROMPTS.get(domain, "") + "\n\n" + _GENERATION_GUIDELINES
+        self._static_format_args = {
+            "session_threshold": session_threshold,
+            "min_evidences": min_evidences,
+            "max_evidences": max_evidences,
+        }
+        self._prompt_templates: Dict[DifficultyLevel, Tuple[str, ...]] = {}  # 难度 -> 以会话上下文分隔的模板片段
+        # 会话上下文移到提示词末尾：同一难度的请求在上下文之前的部分（含规则和输出格式）完全相同，便于服务端前缀缓存
+        self.context_last = context_last
+        # 启动时即为本领域已有的各难度模板填入固定参数，生成过程中只做一次拼接；模板格式错误也在启动时暴露
+        for difficulty in get_args(DifficultyLevel):
+            if f"{domain}_structured_{difficulty}_template_en" in QA_GENERATION_PROMPTS:
+                self._get_prompt_template(difficulty)
+        # 单个会话渲染后的上下文文本缓存：session_id -> 文本
+        self._session_text_cache: Dict[str, str] = {}
+        self._rendering: Dict[str, Future] = {}  # session_id -> 正在渲染的会话文本
+        self._rendering_lock = threading.Lock()
+        self._sorted_sessions_cache: Dict[str, List[Session]] = {}  # conversation_id -> 按编号排序的全部会话
+        self._guidance_cache: Dict[Tuple[Tuple[str, ...], Tuple[str, ...]], str] = {}  # 示例 qa_id -> 指导文本
+        # 医疗领域的表格类型只在表头行写一次（减少每行重复的提示词 token）
+        self.table_type_in_header = table_type_in_header
+        self._last_context: Tuple[Tuple[str, ...], str] = ((), "")  # 最近一次拼接的 (会话id元组, 上下文)
+        # 会话抽样的随机种子（None 表示不固定）；每个 (对话, 难度) 的下一个生成序号
+        self.seed = seed
+        self._slot_counters: Dict[Tuple[str, DifficultyLevel], int] = {}
+        self.num_workers = max(1, num_workers)  # 非逐步模式下按对话划分的生成进程数
+        # LLM 回复的精确匹配缓存：配合 seed 使用时，中断后重新运行可直接复用尚未写入QA缓存的回复
+        self.response_cache = LLMResponseCache(os.path.join(cache_dir, "llm_responses.jsonl")) if use_response_cache else None
+        self.response_cache_match = response_cache_match  # 回复缓存的匹配方式，见 _response_cache_key
+        # 非逐步模式下每次请求采样的回复数（请求参数 n），同一 (对话, 难度) 的多个QA共用一次提示词预填充；
+        # 0 表示按每个 (对话, 难度) 待生成的数量自动决定（见 _split_samples）
+        self.samples_per_request = max(0, samples_per_request)
+        if temperature == 0 and self.samples_per_request != 1:
+            # 温度为 0 时同一请求的多个采样相同，且相同请求会合并为一次只取一个回复的调用（见 _request_coalesced）
+            self.logger.warning(f"temperature 为 0 时每次请求只采样一个回复，忽略 samples_per_request={samples_per_request}")
+            self.samples_per_request = 1
+        # 并行渲染大表格会话的进程数（0 表示在当前线程渲染），进程池在 batch_generate 开始时创建、结束时关闭
+        self.render_workers = max(0, render_workers)
+        self._render_pool: ProcessPoolExecutor | None = None
+        self._output_file = None  # batch_generate 期间打开的 JSONL 流式输出文件
+        self.save_every = max(1, save_every)  # 非逐步模式下每生成多少个QA保存一次缓存
+        # 非逐步模式下通过 Batch API 离线生成（费用更低，结果最长 24 小时返回）
+        self.use_batch_api = use_batch_api
+        self.batch_poll_interval = batch_poll_interval
+        # 记录进行中的批处理任务，中断后重新运行时继续等待同一任务
+        self._batch_state_path = os.path.join(cache_dir, "batch_state.json")
 
-    def batch_generate(self, dataset: ConversationDataset, difficulty_counts: Dict[DifficultyLevel, int]):
+    def batch_generate(self, dataset: ConversationDataset, difficulty_counts: Dict[DifficultyLevel, int],
+                       output_path: str | None = None):
         """
         为数据集生成多个QA对（每个对话生成固定数量QA）。
         所有生成的QA都将直接管理在QACacheManager中。
+        若指定 output_path，每个可导出的QA（liked/generated）生成后立即以 JSON Lines 追加写入该文件。
         """
+        if output_path:
+            self._output_file = open(output_path, 'a', encoding='utf-8')
+        if self.render_workers > 0 and self._render_pool is None:
+            # 在启动生成线程和写缓存线程之前创建渲染进程池并立即启动全部子进程：
+            # 生成线程共用这一个进程池，子进程也不会从已有其他线程运行的进程中 fork
+            self._render_pool = ProcessPoolExecutor(max_workers=self.render_workers)
+            self._render_pool.submit(int).result()
+        try:
+            self._batch_generate(dataset, difficulty_counts)
+        finally:
+            # 批量写盘时可能还有未写盘的QA（包括写盘失败的修改），结束（或出错）时统一保存一次；
+            # append_log 时同时压缩缓存日志
+            self.cache_manager.flush()
+            if self._output_file is not None:
+                self._output_file.close()
+                self._output_file = None
+            if self._render_pool is not None:
+                self._render_pool.shutdown(cancel_futures=True)
+                self._render_pool = None
+
+    def _batch_generate(self, dataset: ConversationDataset, difficulty_counts: Dict[DifficultyLevel, int]):
         if self.is_step:
             print("\n--- Step-by-step mode: QA Generation Preview. ---")
             print(f"\n您可以检查缓存文件 {self.cache_manager.current_cache_path} ，然后按回车键继续...")
             input("Press Enter to continue...")
-            self.cache_manager.load_cache() # Reload cache to reflect external changes if any
+            self.cache_manager.load_cache_if_changed() # Reload cache to reflect external changes if any
         
-        self.logger.info(f"Loaded {len(self.cache_manager.get_all_qas())} QAs from cache. Starting global QA index from {len(self.cache_manager.get_exportable_qas())}.")
+        self.logger.info(f"Loaded {len(self.cache_manager.get_all_qas())} QAs from cache. Starting global QA index from {self.cache_manager.count_by_status()}.")
+
+        if not self.is_step:
+            if self.use_batch_api:
+                self._generate_via_batch_api(dataset, difficulty_counts)
+            elif self.num_workers > 1:
+                self._generate_in_processes(dataset, difficulty_counts)
+            # 批处理或子进程中失败的缺口（以及未启用时的全部QA）在当前进程中通过实时接口补齐
+            self._generate_all_concurrently(dataset, difficulty_counts)
+            return
 
         for conversation in dataset.conversations:
+            # 上下文缓存只在同一对话内复用，切换对话时清空以控制内存
+            self._session_text_cache.clear()
+            self._last_context = ((), "")
             for difficulty, num_qa_for_difficulty in difficulty_counts.items():
-                if num_qa_for_difficulty == 0:
-                    self.logger.debug(f"Skipping generation for '{difficulty}' difficulty as count is 0.")
-                    continue
-
-                self.logger.info(f"开始为对话 '{conversation.id}' 生成 {num_qa_for_difficulty} 个 '{difficulty}' 难度的问题...")
-                self.difficulty = difficulty
-
-                # 从cache恢复已生成的个数 F(conversation,difficulty,status)
-                generated_count_for_current_difficulty = len(
-                    [qa for qa in self.cache_manager.get_all_qas(difficulty=difficulty) 
-                     if qa.get("conversation_id") == conversation.id and qa.get("status") in ["liked", "generated"]]
-                )
-
+                generated_count_for_current_difficulty = self._get_generated_count(conversation, difficulty, num_qa_for_difficulty)
                 if generated_count_for_current_difficulty >= num_qa_for_difficulty:
-                    self.logger.info(f"Skipping generation for '{difficulty}' difficulty as already generated {generated_count_for_current_difficulty}/{num_qa_for_difficulty} QAs.")
                     continue
+                self.difficulty = difficulty
 
                 while generated_count_for_current_difficulty < num_qa_for_difficulty:
-                    qa_dict, _ = self._generate_single_qa(conversation)
+                    qa_dict, _ = self._generate_single_qa(conversation, difficulty, self._next_slot(conversation.id, difficulty))
                     if qa_dict:
                         generated_count_for_current_difficulty += 1
-                        self.logger.info(f"成功生成了第 {generated_count_for_current_difficulty}/{num_qa_for_difficulty} 个 '{self.difficulty}' 难度QA")
+                        self.logger.info(f"成功生成了第 {generated_count_for_current_difficulty}/{num_qa_for_difficulty} 个 '{difficulty}' 难度QA")
                     else:
-                        self.logger.info(f"重新生成第{generated_count_for_current_difficulty}/{num_qa_for_difficulty} 个 '{self.difficulty}' 难度QA")
+                        self.logger.info(f"重新生成第{generated_count_for_current_difficulty}/{num_qa_for_difficulty} 个 '{difficulty}' 难度QA")
+
+    def _get_generated_count(self, conversation: Conversation, difficulty: DifficultyLevel, num_qa_for_difficulty: int) -> int:
+        """从cache恢复 (对话, 难度) 已生成的个数 F(conversation,difficulty,status)，并记录进度日志"""
+        if num_qa_for_difficulty == 0:
+            self.logger.debug(f"Skipping generation for '{difficulty}' difficulty as count is 0.")
+            return 0
 
-    def _generate_single_qa(self, conversation: Conversation) -> Tuple[Dict | None, List[Session]]:
+        generated_count = self.cache_manager.count(conversation.id, difficulty, ("liked", "generated"))
+        if generated_count >= num_qa_for_difficulty:
+            self.logger.info(f"Skipping generation for '{difficulty}' difficulty of '{conversation.id}' as already generated {generated_count}/{num_qa_for_difficulty} QAs.")
+        else:
+            self.logger.info(f"开始为对话 '{conversation.id}' 生成 {num_qa_for_difficulty - generated_count} 个 '{difficulty}' 难度的问题...")
+        return generated_count
+
+    def _generate_in_processes(self, dataset: ConversationDataset, difficulty_counts: Dict[DifficultyLevel, int]):
         """
-        生成单个QA对，并处理缓存逻辑和用户交互。
-        返回生成的QA字典和所选会话列表，如果生成失败或用户拒绝则返回 (None, None)。
+        非逐步模式下按对话将数据集划分给 num_workers 个子进程并行生成。
+        每个子进程使用独立的缓存目录（初始为主缓存和回复缓存的副本，保留断点、偏好示例和已有回复），
+        并发和限流额度在子进程间平分；全部结束后将子进程缓存中的新QA和新回复合并回主缓存并删除子进程缓存。
+        """
+        partitions = [dataset.conversations[i::self.num_workers] for i in range(self.num_workers)]
+        partitions = [p for p in partitions if p]
+        worker_kwargs = {
+            **self._init_kwargs,
+            "max_concurrency": max(1, self.max_concurrency // len(partitions)),
+            "qpm": -(-self._init_kwargs["qpm"] // len(partitions)),
+            "tpm": -(-self._init_kwargs["tpm"] // len(partitions)),
+            "render_workers": 0,
+            "num_workers": 1,
+        }
+        # 先落盘，子进程从主缓存的副本开始
+        self.cache_manager.save_cache()
+        worker_dirs = [os.path.join(self.cache_manager.cache_dir, f"worker_{i}") for i in range(len(partitions))]
+        for worker_dir in worker_dirs:
+            worker_cache = os.path.join(worker_dir, os.path.basename(self.cache_manager.current_cache_path))
+            # 上次中断遗留的子进程缓存直接沿用
+            if not os.path.exists(worker_cache):
+                os.makedirs(worker_dir, exist_ok=True)
+                shutil.copyfile(self.cache_manager.current_cache_path, worker_cache)
+                if self.response_cache is not None and os.path.exists(self.response_cache.path):
+                    shutil.copyfile(self.response_cache.path,
+                                    os.path.join(worker_dir, os.path.basename(self.response_cache.path)))
+
+        self.logger.info(f"使用 {len(partitions)} 个进程并行生成，每个进程最大并发 {worker_kwargs['max_concurrency']}")
+        with ProcessPoolExecutor(max_workers=len(partitions)) as executor:
+            futures = [
+                executor.submit(_generate_partition, {**worker_kwargs, "cache_dir": worker_dir},
+                                ConversationDataset(partition), difficulty_counts)
+                for worker_dir, partition in zip(worker_dirs, partitions)
+            ]
+            for future in futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    # 失败进程已生成的QA仍在其缓存中，合并后由当前进程补齐缺口
+                    self.logger.error(f"生成子进程出错: {e}", exc_info=True)
+
+        for worker_dir in worker_dirs:
+            worker_cache = QACacheManager(worker_dir, append_log=self.cache_manager.append_log,
+                                          cache_format=self.cache_manager.cache_format)
+            merged = 0
+            for qa in worker_cache.get_all_qas():
+                if self.cache_manager.get_qa_by_id(qa["qa_id"]) is None:
+                    self._record_qa(qa, status=qa["status"])
+                    merged += 1
+            self.logger.info(f"从 {worker_dir} 合并了 {merged} 个QA")
+            if self.response_cache is not None:
+                # 子进程收到的回复也并入主回复缓存，删除子进程目录后重新运行仍可复用
+                worker_responses = os.path.join(worker_dir, os.path.basename(self.response_cache.path))
+                if os.path.exists(worker_responses):
+                    merged = self.response_cache.merge(worker_responses)
+                    self.logger.info(f"从 {worker_dir} 合并了 {merged} 条LLM回复")
+        self.cache_manager.save_cache()
+        for worker_dir in worker_dirs:
+            shutil.rmtree(worker_dir)
+
+    def _generate_via_batch_api(self, dataset: ConversationDataset, difficulty_counts: Dict[DifficultyLevel, int]):
+        """
+        非逐步模式下通过 Batch API 生成QA：为每个待生成槽位写一行请求，上传后提交批处理任务并轮询，
+        完成后逐条解析结果写入缓存。批处理任务ID和请求元数据保存在 batch_state.json 中，
+        中断后重新运行会继续等待已提交的任务而不是重复提交。
+        """
+        if os.path.exists(self._batch_state_path):
+            state = load_json(self._batch_state_path)
+            self.logger.info(f"继续等待已提交的批处理任务 {state['batch_id']}")
+        else:
+            state = self._submit_batch(dataset, difficulty_counts)
+            if state is None:
+                return
+
+        batch = self._wait_for_batch(state["batch_id"])
+        if batch.status == "completed" and batch.output_file_id:
+            output_text = client.files.content(batch.output_file_id).text
+            try:
+                self._ingest_batch_output(output_text, state["requests"])
+            finally:
+                # 结果已下载：解析中途出错时也不再继续等待同一任务，否则每次重新运行都会在同一处失败
+                os.remove(self._batch_state_path)
+        else:
+            self.logger.warning(f"批处理任务 {batch.id} 结束状态为 '{batch.status}'，未完成的QA将通过实时接口生成")
+            os.remove(self._batch_state_path)
+
+    def _submit_batch(self, dataset: ConversationDataset, difficulty_counts: Dict[DifficultyLevel, int]) -> Dict | None:
+        """构建批处理请求文件并提交任务，返回保存到 batch_state.json 的状态；无待生成QA时返回 None"""
+        conversations = {conversation.id: conversation for conversation in dataset.conversations}
+        remaining = self._plan_remaining(dataset, difficulty_counts)
+        if not remaining:
+            return None
+
+        requests: Dict[str, Dict] = {}  # custom_id -> 结果解析所需的元数据
+        lines = []
+        for (conversation_id, difficulty), count in remaining.items():
+            for n in self._split_samples(count):
+                slot = self._next_slot(conversation_id, difficulty)
+                messages, extra_body, selected_sessions = self._prepare_request(conversations[conversation_id], difficulty, slot)
+                # 批处理为非流式调用，不支持深度思考
+                body = {"model": self._model_for(difficulty), "messages": messages, **extra_body, "enable_thinking": False}
+                if n > 1:
+                    body["n"] = n
+                custom_id = f"{conversation_id}:{difficulty}:{slot}"
+                lines.append(dumps_json({"custom_id": custom_id, "method": "POST",
+                                         "url": "/v1/chat/completions", "body": body}))
+                requests[custom_id] = {"conversation_id": conversation_id, "difficulty": difficulty,
+                                       "session_ids": [s.id for s in selected_sessions]}
+            # 提交后不再需要该对话的上下文文本
+            for session in conversations[conversation_id].sessions:
+                self._session_text_cache.pop(session.id, None)
+
+        input_path = os.path.join(os.path.dirname(self._batch_state_path), "batch_input.jsonl")
+        with open(input_path, 'w', encoding='utf-8') as f:
+            f.write("\n".join(lines) + "\n")
+        with open(input_path, 'rb') as f:
+            input_file = client.files.create(file=f, purpose="batch")
+        batch = client.batches.create(input_file_id=input_file.id, endpoint="/v1/chat/completions",
+                                      completion_window="24h")
+        self.logger.info(f"已提交批处理任务 {batch.id}，共 {len(requests)} 个请求")
+
+        state = {"batch_id": batch.id, "requests": requests}
+        dump_json(state, self._batch_state_path)
+        return state
+
+    def _wait_for_batch(self, batch_id: str):
+        """轮询批处理任务直到结束（completed/failed/expired/cancelled），返回最终的任务对象"""
+        while True:
+            batch = client.batches.retrieve(batch_id)
+            if batch.status in ("completed", "failed", "expired", "cancelled"):
+                return batch
+            counts = batch.request_counts
+            progress = f"{counts.completed}/{counts.total}" if counts else "-"
+            self.logger.info(f"批处理任务 {batch_id} 状态: {batch.status}，进度 {progress}")
+            time.sleep(self.batch_poll_interval)
+
+    def _ingest_batch_output(self, output_text: str, requests: Dict[str, Dict]):
+        """解析批处理结果文件，成功的QA写入缓存；失败或格式错误的记录只记录日志并跳过，由实时接口补齐"""
+        added = 0
+        for line in output_text.splitlines():
+            if not line.strip():
+                continue
+            try:
+                record = loads_json(line)
+                meta = requests.get(record.get("custom_id"))
+                response = record.get("response") or {}
+                if meta is None or response.get("status_code") != 200:
+                    self.logger.warning(f"批处理请求 {record.get('custom_id')} 失败: {record.get('error')}")
+                    continue
+                qa_responses = [choice["message"]["content"] for choice in response["body"]["choices"]]
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                self.logger.warning(f"跳过无法解析的批处理结果记录: {e!r}（{line[:200]}）")
+                continue
+            for qa_response in qa_responses:
+                qa_dict = self._build_qa(qa_response, meta["conversation_id"], meta["difficulty"], meta["session_ids"])
+                if qa_dict:
+                    self._record_qa(qa_dict, status="generated")
+                    added += 1
+        self.logger.info(f"批处理结果中成功解析 {added} 个QA（共 {len(requests)} 个请求）")
+
+    def _plan_remaining(self, dataset: ConversationDataset,
+                        difficulty_counts: Dict[DifficultyLevel, int]) -> Dict[Tuple[str, DifficultyLevel], int]:
+        """统计每个 (对话, 难度) 还需生成的QA数量（已满足的不包含在内）"""
+        remaining: Dict[Tuple[str, DifficultyLevel], int] = {}
+        for conversation in dataset.conversations:
+            for difficulty, num_qa_for_difficulty in difficulty_counts.items():
+                generated_count = self._get_generated_count(conversation, difficulty, num_qa_for_difficulty)
+                if generated_count < num_qa_for_difficulty:
+                    remaining[(conversation.id, difficulty)] = num_qa_for_difficulty - generated_count
+        return remaining
+
+    def _generate_all_concurrently(self, dataset: ConversationDataset, difficulty_counts: Dict[DifficultyLevel, int]):
+        """
+        非逐步模式：先统计所有 (对话, 难度) 还需生成的QA数量，展开为待生成槽位队列，
+        线程池中始终保持 max_concurrency 个在途请求：每完成一个就补充下一个槽位，
+        失败的槽位放回队首优先重试，直到每个 (对话, 难度) 的数量足够。
+        samples_per_request > 1 时每个槽位一次请求采样多个QA，未成功的部分合并为一个槽位重试。
+        工作线程只负责调用LLM生成候选QA，写入缓存统一在当前线程完成。
+        """
+        conversations = {conversation.id: conversation for conversation in dataset.conversations}
+        remaining = self._plan_remaining(dataset, difficulty_counts)
+        # 每个对话还需生成的QA数，归零后释放该对话的上下文缓存
+        remaining_per_conversation = Counter()
+        for (conversation_id, _), count in remaining.items():
+            remaining_per_conversation[conversation_id] += count
+        self.logger.info(f"共需生成 {sum(remaining.values())} 个QA，最大并发 {self.max_concurrency}")
+
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            def submit(pending: Tuple[Tuple[str, DifficultyLevel], int]):
+                (conversation_id, difficulty), n = pending
+                slot = self._next_slot(conversation_id, difficulty)
+                futures[executor.submit(self._generate_qa_candidates, conversations[conversation_id], difficulty, slot, n)] = pending
+
+            def refill():
+                while pending_jobs and len(futures) < self.max_concurrency:
+                    submit(pending_jobs.popleft())
+
+            # 按对话排列的待生成槽位；只按需提交，同一时间在途的对话很少，会话文本缓存命中率高
+            # 预计耗时长的对话和难度排在前面，避免最后只剩少数长请求拖慢结束
+            # 每项为 ((对话, 难度), 本次请求的QA数)
+            pending_jobs = deque((job, n) for job in self._order_jobs(remaining, conversations)
+                                 for n in self._split_samples(remaining[job]))
+            futures = {}
+            try:
+                refill()
+                while futures:
+                    done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        job, n = futures.pop(future)
+                        conversation_id, difficulty = job
+                        qa_dicts, _ = future.result()
+                        if len(qa_dicts) < n:
+                            self.logger.info(f"重新生成对话 '{conversation_id}' 的 '{difficulty}' 难度QA（剩余 {remaining[job] - len(qa_dicts)} 个）")
+                            pending_jobs.appendleft((job, n - len(qa_dicts)))
+
+                        for qa_dict in qa_dicts:
+                            self._record_qa(qa_dict, status="generated")
+                            self.logger.info(f"QA {qa_dict['qa_id']} added as 'generated'.")
+                            remaining[job] -= 1
+                            self.logger.info(f"成功生成对话 '{conversation_id}' 的 '{difficulty}' 难度QA（剩余 {remaining[job]} 个）")
+                            remaining_per_conversation[conversation_id] -= 1
+                        if qa_dicts and remaining_per_conversation[conversation_id] == 0:
+                            for session in conversations[conversation_id].sessions:
+                                self._session_text_cache.pop(session.id, None)
+                    refill()
+            finally:
+                # 出错时取消尚未开始的任务，避免退出线程池时仍逐个执行
+                for future in futures:
+                    future.cancel()
+
+    @staticmethod
+    def _order_jobs(remaining: Dict[Tuple[str, DifficultyLevel], int],
+                    conversations: Dict[str, Conversation]) -> List[Tuple[str, DifficultyLevel]]:
+        """
+        按预计耗时从长到短排列 (对话, 难度)：对话按剩余工作量（会话平均表格行数 × 按难度加权的剩余QA数）排序，
+        同一对话内的任务保持相邻（会话文本缓存仍按对话释放），对话内难度高的在前。
+        """
+        work = Counter()
+        for (conversation_id, difficulty), count in remaining.items():
+            work[conversation_id] += count * (_DIFFICULTY_RANK[difficulty] + 1)
+        for conversation_id in work:
+            sessions = conversations[conversation_id].sessions
+            rows = sum(len(table.rows) for session in sessions for table in session.tables or ())
+            work[conversation_id] *= 1 + rows / max(1, len(sessions))
+        return sorted(remaining, key=lambda job: (-work[job[0]], job[0], -_DIFFICULTY_RANK[job[1]]))
+
+    def _split_samples(self, count: int) -> List[int]:
+        """
+        将 count 个待生成QA按 samples_per_request 划分为每次请求的采样数。
+        samples_per_request 为 0 时自动划分：用尽量少的请求（每次至多 _MAX_AUTO_SAMPLES 个）覆盖 count，
+        各请求的采样数尽量平均（如 5 个划分为 3 + 2 而不是 4 + 1），使各请求的耗时接近。
+        """
+        n = self.samples_per_request
+        if n == 0:
+            requests = -(-count // _MAX_AUTO_SAMPLES)
+            base, extra = divmod(count, requests) if requests else (0, 0)
+            return [base + 1] * extra + [base] * (requests - extra)
+        return [n] * (count // n) + ([count % n] if count % n else [])
+
+    def _next_slot(self, conversation_id: str, difficulty: DifficultyLevel) -> int:
+        """
+        返回 (对话, 难度) 的下一个生成序号（每次尝试加 1，包括失败重试）。
+        首次调用时从缓存中已生成的数量开始，重新运行时会沿用相同的序号。只在主线程中调用。
+        """
+        key = (conversation_id, difficulty)
+        if key not in self._slot_counters:
+            self._slot_counters[key] = self.cache_manager.count(conversation_id, difficulty, ("liked", "generated"))
+        slot = self._slot_counters[key]
+        self._slot_counters[key] += 1
+        return slot
+
+    def _sorted_sessions(self, conversation: Conversation) -> List[Session]:
+        """对话的全部会话按编号排序（见 _session_sort_key），每个对话只排序一次"""
+        sessions = self._sorted_sessions_cache.get(conversation.id)
+        if sessions is None:
+            sessions = self._sorted_sessions_cache[conversation.id] = sorted(conversation.sessions, key=_session_sort_key)
+        return sessions
+
+    def _session_rng(self, conversation_id: str, difficulty: DifficultyLevel, slot: int | None) -> random.Random:
+        """
+        会话和示例抽样使用的随机数生成器。设置了 seed 时按 (seed, 对话, 难度, 序号) 确定性地构造，
+        相同输入重新运行会选出相同的会话和示例（提示词前缀相同，可命中服务端前缀缓存）；否则使用全局 random。
+        """
+        if self.seed is None or slot is None:
+            return random
+        # 使用字符串作为种子：hash() 对字符串在不同进程间不稳定
+        return random.Random(f"{self.seed}:{conversation_id}:{difficulty}:{slot}")
+
+    def _generate_qa_candidate(self, conversation: Conversation, difficulty: DifficultyLevel,
+                               slot: int | None = None) -> Tuple[Dict | None, List[Session]]:
+        """
+        随机选择会话并调用LLM生成一个候选QA（不写入缓存，可在工作线程中执行）。
+        返回QA字典和所选会话列表，生成或解析失败时返回 (None, None)。
+        """
+        qa_dicts, selected_sessions = self._generate_qa_candidates(conversation, difficulty, slot)
+        if not qa_dicts:
+            return None, None
+        return qa_dicts[0], selected_sessions
+
+    def _generate_qa_candidates(self, conversation: Conversation, difficulty: DifficultyLevel,
+                                slot: int | None = None, n: int = 1) -> Tuple[List[Dict], List[Session]]:
+        """
+        随机选择会话并调用LLM生成至多 n 个候选QA（不写入缓存，可在工作线程中执行）。
+        n > 1 时在一次请求中采样 n 个回复，n 个QA共用同一组会话和同一次提示词预填充。
+        返回解析成功的QA列表（同一问题只保留一个）和所选会话列表。
+        """
+        messages, extra_body, selected_sessions = self._prepare_request(conversation, difficulty, slot)
+        model = self._model_for(difficulty)
+        self.logger.info(f"正在使用 {model} 为难度 '{difficulty}' 生成QA...")
+        cache_key = None
+        responses = []
+        if self.response_cache is not None:
+            cache_key = self._response_cache_key(messages, extra_body, conversation.id, difficulty, selected_sessions, model)
+            while len(responses) < n and (cached := self.response_cache.get(cache_key)) is not None:
+                responses.append(cached)
+            if responses:
+                self.logger.info(f"使用 {len(responses)} 条缓存的LLM回复")
+        if len(responses) < n:
+            if self.temperature == 0:
+                # 确定性采样下多次采样的回复相同，只请求一个
+                # 回复缓存按完整请求匹配时直接复用其键，否则单独计算进行中请求的键
+                key = cache_key if cache_key is not None and self.response_cache_match == "exact" \
+                    else self._inflight_key(messages, extra_body, model)
+                new_responses, shared = self._request_coalesced(key, messages, extra_body, model)
+            else:
+                new_responses, shared = self._request_with_retry(messages, extra_body, n - len(responses), model), False
+            # 合并得到的回复已由发起请求的线程写入回复缓存
+            if cache_key is not None and not shared:
+                for qa_response in new_responses:
+                    if qa_response:
+                        self.response_cache.set(cache_key, qa_response)
+            responses.extend(new_responses)
+
+        session_ids = [s.id for s in selected_sessions]
+        qa_dicts = {}
+        for qa_response in responses:
+            self.logger.debug(f"API response: {qa_response}")
+            qa_dict = self._build_qa(qa_response, conversation.id, difficulty, session_ids)
+            if qa_dict:
+                qa_dicts.setdefault(qa_dict["qa_id"], qa_dict)
+        return list(qa_dicts.values()), selected_sessions
+
+    def _model_for(self, difficulty: DifficultyLevel) -> str:
+        """该难度使用的生成模型"""
+        return self.model_by_difficulty.get(difficulty, self.model)
+
+    def _response_cache_key(self, messages: List[Dict], extra_body: Dict, conversation_id: str,
+                            difficulty: DifficultyLevel, sessions: List[Session], model: str | None = None) -> str:
+        """
+        回复缓存的键。response_cache_match 为 "exact" 时按完整请求匹配；
+        为 "context" 时忽略随机抽取的偏好示例，系统提示、模板、所选会话和请求参数相同即视为同一请求
+        （示例随缓存中的 liked/disliked QA 变化，按完整请求匹配时重新运行几乎无法命中）。
+        """
+        if self.response_cache_match == "exact":
+            return LLMResponseCache.make_key(model or self.model, messages, extra_body)
+        request = {
+            "system": messages[0]["content"],
+            "template": self._get_prompt_template(difficulty),
+            "conversation_id": conversation_id,
+            "session_ids": [session.id for session in sessions],
+        }
+        return LLMResponseCache.make_key(model or self.model, [request], extra_body)
+
+    def _request_with_retry(self, messages: List[Dict], extra_body: Dict, n: int = 1,
+                            model: str | None = None) -> List[str]:
+        """发送请求（采样 n 个回复），限流和网络错误时退避重试"""
+        return retry_with_backoff(
+            lambda: self._request_completion(messages, extra_body, n, model),
+            retry_on=_RETRYABLE_API_ERRORS
+        )
+
+    def _inflight_key(self, messages: List[Dict], extra_body: Dict, model: str | None = None) -> bytes:
+        """进行中请求的合并键：直接对消息内容做 128 位 blake2b 摘要，不先序列化整个请求"""
+        digest = hashlib.blake2b((model or self.model).encode("utf-8"), digest_size=16)
+        for message in messages:
+            digest.update(f"\0{message['role']}\0".encode("utf-8"))
+            digest.update(message["content"].encode("utf-8"))
+        digest.update(dumps_json(extra_body).encode("utf-8"))
+        return digest.digest()
+
+    def _request_coalesced(self, key: str | bytes, messages: List[Dict], extra_body: Dict,
+                           model: str | None = None) -> Tuple[List[str], bool]:
+        """
+        相同请求同一时间只发送一次：已有相同请求在进行中时等待其结果。
+        返回 (回复列表, 是否来自其他线程的请求)。
         """
+        with self._inflight_lock:
+            future = self._inflight.get(key)
+            is_owner = future is None
+            if is_owner:
+                future = self._inflight[key] = Future()
+        if not is_owner:
+            self.logger.info("相同请求正在进行中，等待其结果")
+            return future.result(), True
+        try:
+            responses = self._request_with_retry(messages, extra_body, model=model)
+            future.set_result(responses)
+            return responses, False
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._inflight_lock:
+                del self._inflight[key]
+
+    def _prepare_request(self, conversation: Conversation, difficulty: DifficultyLevel,
+                         slot: int | None = None) -> Tuple[List[Dict], Dict, List[Session]]:
+        """随机选择会话并构建一次生成请求的消息，返回 (messages, extra_body, 所选会话)"""
         # 从conversation中随机选择会话
-        session_count = random.randint(
+        rng = self._session_rng(conversation.id, difficulty, slot)
+        session_count = rng.randint(
             self.min_sessions, min(self.max_sessions, len(conversation.sessions))
         )
-        selected_sessions = random.sample(conversation.sessions, session_count)
-        selected_sessions.sort(key=lambda s: s.id)
+        if session_count >= len(conversation.sessions):
+            # 选中全部会话时无需抽样，直接使用该对话按编号排好序的会话列表
+            selected_sessions = list(self._sorted_sessions(conversation))
+        else:
+            selected_sessions = rng.sample(conversation.sessions, session_count)
+            selected_sessions.sort(key=_session_sort_key)
 
         # Prepare context for LLM
         session_context = self._build_session_context(selected_sessions)
         self.logger.debug(f"session_context:\n{session_context}")
         # Get guidance QAs
+        # 直接从缓存的 (状态, 难度) 分桶中抽取示例，不再取出全部QA后再抽样
         # positive examples (status="liked")
-        preferred_qas = self.cache_manager.get_preferred_qas(self.difficulty)
+        # 使用与会话抽样相同的 rng，设置 seed 时示例也可复现
+        preferred_qas = self.cache_manager.get_preferred_qas(difficulty, self.max_preferred_examples, rng)
         # negative examples (status="disliked")
-        disliked_qas = self.cache_manager.get_disliked_qas(self.difficulty)
+        disliked_qas = self.cache_manager.get_disliked_qas(difficulty, self.max_disliked_examples, rng)
+        # 示例按 qa_id 排序，抽到相同示例时提示词也完全相同
+        preferred_qas.sort(key=itemgetter("qa_id"))
+        disliked_qas.sort(key=itemgetter("qa_id"))
         additional_guidance = self._build_additional_guidance(
             preferred_qas=preferred_qas,
             disliked_qas=disliked_qas
         )
         self.logger.debug(f"additional_guidance:\n{additional_guidance}")
-        qa_response = self._generate_llm_qa(session_context, additional_guidance)
+        messages, extra_body = self._build_llm_request(session_context, additional_guidance, difficulty, conversation.id)
+        return messages, extra_body, selected_sessions
+
+    def _build_qa(self, qa_response: str, conversation_id: str, difficulty: DifficultyLevel,
+                  session_ids: List[str]) -> Dict | None:
+        """解析LLM回复并补充元数据，回复为空或解析失败时返回 None"""
         if not qa_response:
             self.logger.warning("LLM did not return a valid response.")
-            return None, None
+            return None
 
         qa_dict = self._parse_llm_response(qa_response)
         if not qa_dict:
             self.logger.warning("Failed to parse LLM response into a QA dictionary.")
-            return None, None
+            return None
 
         # Add conversation-specific and global metadata
-        qa_dict["conversation_id"] = conversation.id
-        qa_dict["session_ids"] = [s.id for s in selected_sessions]
-        qa_dict["difficulty"] = self.difficulty
+        qa_dict["conversation_id"] = conversation_id
+        qa_dict["session_ids"] = session_ids
+        qa_dict["difficulty"] = difficulty
         qa_dict["qa_id"] = self.cache_manager.generate_qa_id(qa_dict)
         qa_dict["timestamp"] = time.strftime("%Y-%m-%dT%H:%M:%S")
         qa_dict["domain"] = self.domain  # 添加领域标识
+        return qa_dict
+
+    def _generate_single_qa(self, conversation: Conversation, difficulty: DifficultyLevel,
+                            slot: int | None = None) -> Tuple[Dict | None, List[Session]]:
+        """
+        生成单个QA对，并处理缓存逻辑和用户交互。
+        返回生成的QA字典和所选会话列表，如果生成失败或用户拒绝则返回 (None, None)。
+        """
+        qa_dict, selected_sessions = self._generate_qa_candidate(conversation, difficulty, slot)
+        if not qa_dict:
+            return None, None
 
         if self.is_step:
             print("\n--- Step-by-step mode: New QA Generated. ---")
@@ -128,79 +943,140 @@ class QuestionGenerator:
             print(f"\n请检查这次生成的问题。输入 'y' 标记为【偏好问题】（保存进数据集）；输入 'n' 标记为【不喜欢】（保存进cache），并重新生成；输入 'r' 重新生成（不保存进cache）；按回车键标记为【已生成】（保存进数据集）。")
             char = input("输入 'y', 'n', 'r'或回车键继续...\n").strip().lower()
             if char == "y":
-                self.cache_manager.add_qa(qa_dict, status="liked", sql_info=qa_dict.get("sql_info"))
-                self.cache_manager.save_cache()
+                self._record_qa(qa_dict, status="liked")
                 self.logger.info(f"QA {qa_dict['qa_id']} marked as 'liked'.")
                 return qa_dict, selected_sessions
             elif char == "n":
-                self.cache_manager.add_qa(qa_dict, status="disliked", sql_info=qa_dict.get("sql_info"))
-                self.cache_manager.save_cache()
+                self._record_qa(qa_dict, status="disliked")
                 self.logger.info(f"QA {qa_dict['qa_id']} marked as 'disliked'. Re-generating...")
                 return None, None # Signal to re-generate
             elif char == "r":
                 self.logger.info(f"QA {qa_dict['qa_id']} marked as 'rejected'. Re-generating...")
                 return None, None # Signal to re-generate
             else:
-                self.cache_manager.add_qa(qa_dict, status="generated", sql_info=qa_dict.get("sql_info"))
-                self.cache_manager.save_cache()
+                self._record_qa(qa_dict, status="generated")
                 self.logger.info(f"QA {qa_dict['qa_id']} marked as 'generated'.")
                 return qa_dict, selected_sessions
         else:
-            self.cache_manager.add_qa(qa_dict, status="generated", sql_info=qa_dict.get("sql_info"))
-            self.cache_manager.save_cache()
+            self._record_qa(qa_dict, status="generated")
             self.logger.info(f"QA {qa_dict['qa_id']} added as 'generated'.")
             return qa_dict, selected_sessions
 
+    def _maybe_save_cache(self):
+        """
+        保存QA缓存。逐步模式下每次都立即保存（便于人工检查缓存文件）；
+        否则由 maybe_flush 批量写盘：累计 save_every 个QA或距上次写盘较久时才整体写一次文件，
+        append_log 时每个QA已追加到缓存日志，只在日志较长时压缩一次缓存文件。
+        """
+        if self.is_step:
+            self.cache_manager.save_cache()
+        else:
+            self.cache_manager.maybe_flush(max_dirty=self.save_every)
+
+    def _record_qa(self, qa_dict: Dict, status: str):
+        """写入QA缓存并保存；可导出的QA（liked/generated）同时追加到流式输出文件"""
+        self.cache_manager.add_qa(qa_dict, status=status, sql_info=qa_dict.get("sql_info"))
+        self._maybe_save_cache()
+        if self._output_file is not None and status in ("liked", "generated"):
+            self._output_file.write(dumps_json({**qa_dict, "status": status}) + "\n")
+            self._output_file.flush()
+
     def _build_session_context(self, sessions: List[Session]) -> str:
-        context = ""
-        for session in sessions:
-            context += f"### Session ID: {session.id}\n"
-            if session.tables:
-                self.logger.debug(f"会话 {session.id} 构建表格上下文")
-                context += "Data Type: Structured Table\n"
-                for idx, table in enumerate(session.tables):
-                    context += f"Table {idx} (Headers: {', '.join(table.headers)}):\n"
-                    for row_idx, row in enumerate(table.rows):
-                        # 添加表格类型到行数据
-                        if self.domain == "financial":
-                            row_str = ", ".join(f"{k}: {v}" for k, v in row.items())
-                        elif self.domain == "medical":
-                            # 检查表格类型
-                            table_type = getattr(table, 'table_type', 'Unknown')
-                            # 添加表格类型
-                            row['table_type'] = table_type
-                            row_str = ", ".join(f"{k}: {v}" for k, v in row.items())
-
-                        
-                        context += f"  Row {row_idx}: {row_str}\n"
-            else:
-                self.logger.debug(f"会话 {session.id} 构建对话上下文")
-                context += f"Time: {session.time}\n"
-                context += f"Participants: {', '.join(session.participants)}\n"
-                context += "Dialogs:\n"
-                for turn in session.turns:
-                    context += f"Turn {turn.id}: {turn.speaker}: {turn.content}\n"
-            context += "\n"
+        """
+        拼接所选会话的上下文文本，每个会话的文本只渲染一次（见 _render_session）。
+        未缓存的表格会话较多且 batch_generate 创建了渲染进程池时，先用进程池并行渲染这些会话。
+        与上一次选中的会话完全相同时（重新生成时较常见）直接复用上一次拼接的结果。
+        """
+        session_ids = tuple(session.id for session in sessions)
+        last_ids, last_context = self._last_context
+        if session_ids == last_ids:
+            return last_context
+        if self._render_pool is not None:
+            with self._rendering_lock:
+                # 只接手既未缓存、也没有其他线程正在渲染的会话，登记后其他线程等待这里的结果
+                missing = [s for s in sessions if s.id not in self._session_text_cache and s.id not in self._rendering]
+                if len(missing) >= _PARALLEL_RENDER_MIN_SESSIONS and any(s.tables for s in missing):
+                    for session in missing:
+                        self._rendering[session.id] = Future()
+                else:
+                    missing = []
+            if missing:
+                self._render_in_pool(missing)
+        context = "".join(self._render_session(session) for session in sessions)
+        # 只保留最近一次的结果：整体替换元组，多线程读取时也是一致的
+        self._last_context = (session_ids, context)
         return context
-    
+
+    def _render_session(self, session: Session) -> str:
+        """
+        渲染单个会话的上下文文本并按 session.id 缓存。
+        会话在一次运行中不会改变，同一会话被多个QA采样时直接复用。
+        并发生成时同一对话的多个请求几乎同时开始，正在渲染的会话由其他线程等待结果，不重复渲染。
+        """
+        text = self._session_text_cache.get(session.id)
+        if text is not None:
+            return text
+        with self._rendering_lock:
+            # 加锁后再查一次：等待锁期间其他线程可能刚渲染完
+            text = self._session_text_cache.get(session.id)
+            if text is not None:
+                return text
+            future = self._rendering.get(session.id)
+            owner = future is None
+            if owner:
+                future = self._rendering[session.id] = Future()
+        if not owner:
+            return future.result()
+        try:
+            text = self._session_text_cache[session.id] = _render_session_text(
+                session, self.domain == "medical", self.table_type_in_header)
+            future.set_result(text)
+            return text
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._rendering_lock:
+                del self._rendering[session.id]
+
+    def _render_in_pool(self, sessions: List[Session]):
+        """
+        用渲染进程池渲染已登记在 _rendering 中的会话，与 _render_session 一样写入缓存并把结果交给等待的线程。
+        """
+        futures = [self._rendering[session.id] for session in sessions]
+        try:
+            is_medical = self.domain == "medical"
+            texts = self._render_pool.map(_render_session_text, sessions, [is_medical] * len(sessions),
+                                          [self.table_type_in_header] * len(sessions))
+            for session, future, text in zip(sessions, futures, texts):
+                self._session_text_cache[session.id] = text
+                future.set_result(text)
+        except BaseException as e:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+            raise
+        finally:
+            with self._rendering_lock:
+                for session in sessions:
+                    del self._rendering[session.id]
+
     def _build_additional_guidance(self, preferred_qas: List[Dict], disliked_qas: List[Dict]) -> str:
         """
-        构建额外的指导信息，包含偏好问题、不偏好问题。
+        构建额外的指导信息，包含偏好问题、不偏好问题（传入的示例已按数量上限抽样）。
+        同一组示例（按 qa_id）的结果缓存在实例上：示例池不超过抽样上限时每次抽到的都是同一组。
         """
-        guidance = ""
-        # Section 1: Crucial Instructions (Prioritize Uniqueness and Diversity)
-        guidance += (
-            "### IMPORTANT GENERATION GUIDELINES:\n"
-            "Your primary goal is to generate a **NEW, UNIQUE, and SEMANTICALLY DISTINCT question** based on the provided context.\n"
-            "**DO NOT** merely rephrase or slightly alter any existing question. Strive for **stylistic and semantic diversity**.\n"
-            "Explore different facts, aspects, or aggregation types within the context to formulate truly novel questions.\n"
-            "The question must be answerable solely from the provided context.\n\n"
-        )
+        key = (tuple(qa["qa_id"] for qa in preferred_qas), tuple(qa["qa_id"] for qa in disliked_qas))
+        guidance = self._guidance_cache.get(key)
+        if guidance is not None:
+            return guidance
+        # 各段落先收集到列表，最后一次性拼接
+        # Section 1 (固定的生成准则) 不随调用变化，已放入 system 消息，见 _GENERATION_GUIDELINES
+        parts = []
 
         # Section 2: Preferred Questions (Positive Examples)
-        selected_preferred_qas = random.sample(preferred_qas, min(len(preferred_qas), self.max_preferred_examples))
-        if selected_preferred_qas:
-            guidance += (
+        if preferred_qas:
+            parts.append(
                 "### Preferred Questions (High-quality examples):\n"
                 "These examples showcase the **desired characteristics** for new questions. "
                 "**Crucially, DO NOT replicate their exact phrasing or merely substitute entities.** "
@@ -211,66 +1087,150 @@ class QuestionGenerator:
                 "- **Complexity:** How does it achieve the desired difficulty level?\n"
                 "Your task is to generate **semantically unique questions** that adhere to these principles, but are distinct in their wording and specific focus.\n"
             )
-            for idx, qa in enumerate(selected_preferred_qas):
-                guidance += f" Good Example {idx + 1}:\n"
-                guidance += f" Question: {qa.get('question_text')}\n"
-                guidance += f" Answer: {qa.get('answer_text')}\n"
-                guidance += "\n"
+            for idx, qa in enumerate(preferred_qas):
+                parts.append(
+                    f" Good Example {idx + 1}:\n"
+                    f" Question: {qa.get('question_text')}\n"
+                    f" Answer: {qa.get('answer_text')}\n"
+                    "\n"
+                )
 
         # Section 3: Disliked Questions (Negative Examples)
-        selected_disliked_qas = random.sample(disliked_qas, min(len(disliked_qas), self.max_disliked_examples))
-        if selected_disliked_qas:
-            guidance += (
+        if disliked_qas:
+            parts.append(
                 "### Disliked Questions (Examples to AVOID generating):\n"
                 "These examples were deemed low-quality, irrelevant, or undesirable. "
                 "**Pay close attention to what makes them bad.** Is it due to ambiguity, lack of answerability, redundancy, or irrelevant details?\n"
                 "**Absolutely DO NOT generate questions that are semantically identical or very similar to these in form or content.** "
                 "Learn from their flaws to prevent similar mistakes in your new questions.\n"
             )
-            for idx, qa in enumerate(selected_disliked_qas):
-                guidance += f" Bad Example {idx + 1}:\n"
-                guidance += f" Question: {qa.get('question_text', 'N/A')}\n"
-                guidance += "\n"
+            for idx, qa in enumerate(disliked_qas):
+                parts.append(
+                    f" Bad Example {idx + 1}:\n"
+                    f" Question: {qa.get('question_text', 'N/A')}\n"
+                    "\n"
+                )
+        guidance = "".join(parts)
+        if len(self._guidance_cache) >= _GUIDANCE_CACHE_SIZE:
+            self._guidance_cache.clear()
+        self._guidance_cache[key] = guidance
         return guidance
 
-    def _generate_llm_qa(self, session_context: str, additional_guidance: str) -> str:
-        """生成单个QA对"""
-        domain = self.domain
+    def _build_llm_request(self, session_context: str, additional_guidance: str, difficulty: DifficultyLevel,
+                           conversation_id: str = "") -> Tuple[List[Dict], Dict]:
+        """
+        构建生成单个QA对的请求，返回 (messages, extra_body)。
+        消息按“固定内容在前、可变内容在后”排列：system（角色 + 生成准则）→ 模板与会话上下文 → 随机抽样的示例，
+        以便服务端对相同前缀做缓存。
+        """
         # 获取系统提示
-        system_role = SYSTEM_PROMPTS.get(domain, "")
-        template_key = f"{domain}_structured_{self.difficulty}_template_en"
-
-        if template_key not in QA_GENERATION_PROMPTS:
-            self.logger.error(f"未找到模板 '{template_key}'，使用默认模板")
-            raise ValueError(f"未找到模板 '{template_key}'")
-        prompt = QA_GENERATION_PROMPTS[template_key].format(
-            session_context=session_context,
-            session_threshold=self.session_threshold,
-            min_evidences=self.min_evidences,
-            max_evidences=self.max_evidences
-        )
+        system_role = self._system_prompt
+        parts = self._get_prompt_template(difficulty)
         if additional_guidance:
-            prompt += additional_guidance
+            # 示例接在最后一个模板片段上再一次性拼接，不在拼好的长提示词后追加（避免再复制一遍会话上下文）
+            parts = (*parts[:-1], parts[-1] + additional_guidance)
+        prompt = session_context.join(parts)
 
         messages = [
             {"role": "system", "content": system_role},
             {"role": "user", "content": prompt},
         ]
         self.logger.debug(f"Prompt:{messages}")
-        self.logger.info(f"正在为难度 '{self.difficulty}' 生成QA...")
-        completion = client.chat.completions.create(
-            model=self.model,
-            messages=messages,
-            stream=True,
-            extra_body={"enable_thinking": True}
-        )
+        extra_body = {"enable_thinking": self.enable_thinking}
+        if self.temperature is not None:
+            extra_body["temperature"] = self.temperature
+        if self.use_prompt_cache_key:
+            # 同一 (对话, 难度) 的请求共享前缀，路由到同一缓存
+            extra_body["prompt_cache_key"] = f"{conversation_id}:{difficulty}"
+        return messages, extra_body
 
-        response_content = ""
-        for chunk in completion:
-            if chunk.choices[0].delta.content:
-                response_content += chunk.choices[0].delta.content
-        self.logger.debug(f"API response: {response_content}")
-        return response_content
+    def _get_prompt_template(self, difficulty: DifficultyLevel) -> Tuple[str, ...]:
+        """
+        按难度查找QA生成模板，返回以会话上下文为分隔的模板片段（用 session_context.join 拼回完整提示词）。
+        固定参数在初始化时就填入模板（见 __init__），结果缓存在实例上，之后每次调用不再解析模板。
+        """
+        parts = self._prompt_templates.get(difficulty)
+        if parts is None:
+            template_key = f"{self.domain}_structured_{difficulty}_template_en"
+            if template_key not in QA_GENERATION_PROMPTS:
+                self.logger.error(f"未找到模板 '{template_key}'，使用默认模板")
+                raise ValueError(f"未找到模板 '{template_key}'")
+            if self.context_last:
+                # 模板中只保留指向末尾的说明，上下文接在整个模板之后
+                rendered = QA_GENERATION_PROMPTS[template_key].format_map(
+                    ChainMap({"session_context": _CONTEXT_POINTER}, self._static_format_args)
+                )
+                parts = (rendered + _TRAILING_CONTEXT_HEADER, "")
+            else:
+                rendered = QA_GENERATION_PROMPTS[template_key].format_map(
+                    ChainMap({"session_context": _CONTEXT_PLACEHOLDER}, self._static_format_args)
+                )
+                parts = tuple(rendered.split(_CONTEXT_PLACEHOLDER))
+            self._prompt_templates[difficulty] = parts
+        return parts
+
+    def _request_completion(self, messages: List[Dict], extra_body: Dict, n: int = 1,
+                            model: str | None = None) -> List[str]:
+        """
+        发送一次请求并返回 n 个回复的完整文本（n > 1 时服务端对同一提示词采样 n 次）。
+        请求受 QPM/TPM 限流和 AIMD 并发上限约束；被限流（429）时并发上限减半。
+        model 未指定时使用 self.model。
+        """
+        model = model or self.model
+        # n 为 1 时不传，请求与之前完全相同
+        sampling = {"n": n} if n > 1 else {}
+        self.concurrency_limiter.acquire()
+        rate_limited = False
+        try:
+            self.rate_limiter.acquire()
+            if not self.enable_thinking:
+                # 不需要深度思考时直接使用非流式调用，省去逐分片的处理
+                completion = self._client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    stream=False,
+                    extra_body=extra_body,
+                    **sampling
+                )
+                if getattr(completion, "usage", None):
+                    self.rate_limiter.record_tokens(completion.usage.total_tokens)
+                return [choice.message.content or "" for choice in sorted(completion.choices, key=lambda c: c.index)]
+
+            completion = self._client.chat.completions.create(
+                model=model,
+                messages=messages,
+                stream=True,
+                stream_options={"include_usage": True},
+                extra_body=extra_body,
+                **sampling
+            )
+
+            # enable_thinking 仅支持流式输出，分片按回复序号收集后一次性拼接，避免字符串反复 += 的二次复制
+            parts = [[] for _ in range(n)]
+            json_ends = [_JsonEndDetector() for _ in range(n)]
+            streamed_chars = 0  # 思考过程和回复的字符数，提前结束时用于估算 token 数
+            for chunk in completion:
+                for choice in chunk.choices:
+                    content = choice.delta.content
+                    streamed_chars += len(content or "") + len(getattr(choice.delta, "reasoning_content", None) or "")
+                    if content:
+                        parts[choice.index].append(content)
+                        json_ends[choice.index].feed(content)
+                # 最后一个分片携带 usage（choices 为空），用于 TPM 统计
+                if getattr(chunk, "usage", None):
+                    self.rate_limiter.record_tokens(chunk.usage.total_tokens)
+                elif all(detector.done for detector in json_ends):
+                    # 每个回复的 JSON 对象都已闭合，之后只剩代码块结束标记或说明文字，提前关闭连接停止生成
+                    completion.close()
+                    prompt_chars = sum(len(message["content"]) for message in messages)
+                    self.rate_limiter.record_tokens((prompt_chars + streamed_chars) // _CHARS_PER_TOKEN)
+                    break
+            return ["".join(choice_parts) for choice_parts in parts]
+        except RateLimitError:
+            rate_limited = True
+            raise
+        finally:
+            self.concurrency_limiter.release(rate_limited=rate_limited)
 
     def _parse_llm_response(self, response: str) -> Dict[str, Any]:
         """
@@ -284,14 +1244,21 @@ class QuestionGenerator:
         }
         """
         try:
-            cleaned_response = response.strip()
-            if cleaned_response.startswith('```json'):
-                cleaned_response = cleaned_response[7:]  # 移除开头的```json
-            if cleaned_response.endswith('```'):
-                cleaned_response = cleaned_response[:-3]  # 移除结尾的```
-            cleaned_response = cleaned_response.strip()
+            # 直接取第一个 '{' 到最后一个 '}' 之间的 JSON 对象，只切片一次；
+            # 同时去掉 ```json 代码块标记和模型在 JSON 前后附加的说明文字
+            start = response.find('{')
+            end = response.rfind('}')
+            cleaned_response = response[start:end + 1] if start != -1 and end > start else response
 
-            data = json.loads(cleaned_response)
+            try:
+                data = loads_json(cleaned_response)
+            except ValueError:
+                # JSON 前的说明文字中也有花括号时，改为取包含 "question" 键的顶层对象
+                detector = _JsonEndDetector()
+                detector.feed(response)
+                if not detector.done:
+                    raise
+                data = loads_json(response[detector.start:detector.end])
 
             question_text = data.get("question", "")
             answer_text = data.get("answer", 0.0)
@@ -300,11 +1267,16 @@ class QuestionGenerator:
 
             # 处理答案文本
             if isinstance(answer_text, str):
-                num_match = re.search(r"-?\d+(?:\.\d+)?", answer_text)
-                if num_match:
-                    answer_text = float(num_match.group(0))
+                # 答案多为纯数字字符串，先直接转换；"nan"/"inf" 等非有限值仍按文本处理
+                try:
+                    number = float(answer_text)
+                except ValueError:
+                    number = None
+                if number is not None and math.isfinite(number):
+                    answer_text = number
                 else:
-                    answer_text = 0.0
+                    num_match = _ANSWER_NUMBER_RE.search(answer_text)
+                    answer_text = float(num_match.group(0)) if num_match else 0.0
             elif isinstance(answer_text, (int, float)):
                 answer_text = float(answer_text)
             else:
@@ -312,19 +1284,21 @@ class QuestionGenerator:
 
             # 处理证据
             evidence = data.get("evidence", [])
-            validated_evidence = []
-            for item in evidence:
-                if isinstance(item, list) and len(item) >= 5:
-                    validated_evidence.append({
-                        "PatientID": str(item[0]),
-                        "time_event": str(item[1]),
-                        "variable_name": str(item[2]),
-                        "value": float(item[3]),
-                        "table_type": str(item[4])
-                    })
-                elif isinstance(item, dict):
-                    validated_evidence.append(item)
-            
+            if all(isinstance(item, list) and len(item) >= 5 for item in evidence):
+                # 常见情况：每条证据都是 [PatientID, time_event, variable_name, value, table_type] 列表，一次推导式完成
+                validated_evidence = [
+                    {
+                        "PatientID": str(patient_id),
+                        "time_event": str(time_event),
+                        "variable_name": str(variable_name),
+                        "value": float(value),
+                        "table_type": str(table_type)
+                    }
+                    for patient_id, time_event, variable_name, value, table_type, *_ in evidence
+                ]
+            else:
+                validated_evidence = self._validate_evidence_items(evidence)
+
             return {
                 "question_text": question_text,
                 "answer_text": answer_text,
@@ -337,16 +1311,73 @@ class QuestionGenerator:
         except Exception as e:
             self.logger.error(f"解析响应时发生错误: {e}")
             return None
+
+    @staticmethod
+    def _validate_evidence_items(evidence: List) -> List[Dict]:
+        """
+        逐条处理混合格式的证据：长度不少于5的列表转换为字典，字典原样保留，其他丢弃。
+        json 解析出的对象类型固定为 list / dict，直接比较类型；字典（混合格式中最常见）先判断。
+        """
+        validated_evidence = []
+        append = validated_evidence.append
+        for item in evidence:
+            item_type = type(item)
+            if item_type is dict:
+                append(item)
+            elif item_type is list and len(item) >= 5:
+                patient_id, time_event, variable_name, value, table_type = item[:5]
+                append({
+                    "PatientID": str(patient_id),
+                    "time_event": str(time_event),
+                    "variable_name": str(variable_name),
+                    "value": float(value),
+                    "table_type": str(table_type)
+                })
+        return validated_evidence
+
+
+def _validation_group_key(qa: Dict) -> Tuple[str, Tuple[str, ...]]:
+    """校验时的分组键：同一对话、同一组会话的QA使用相同的表"""
+    return qa.get("conversation_id") or "", tuple(qa.get("session_ids") or ())
+
+
 class BatchValidator:
     """
     负责对已生成的问题答案对进行SQL验证和智能修正的类。
     """
-    def __init__(self, model: str, domain: str = "financial"):
-        self.sql_engine = SqlEngine()
+    def __init__(self, model: str, domain: str = "financial", max_workers: int = 1):
         self.validator = Validator()
         self.model = model
         self.domain = domain  # 添加领域标识
         self.logger = logging.getLogger(self.__class__.__name__)
+        # 并行校验的线程数；SQLite 连接不能跨线程使用，每个线程各自持有内存库（见 sql_engine）
+        self.max_workers = max(1, max_workers)
+        self._local = threading.local()
+        self._engines: List[SqlEngine] = []  # 各线程创建的引擎，校验结束后统一关闭
+        self._engines_lock = threading.Lock()
+
+    @property
+    def sql_engine(self) -> SqlEngine:
+        """当前线程的 SQL 引擎，首次使用时创建"""
+        engine = getattr(self._local, "sql_engine", None)
+        if engine is None:
+            # 连接只在本线程中使用，但校验结束后由 close 在调用线程统一关闭
+            engine = self._local.sql_engine = SqlEngine(check_same_thread=False)
+            # 已建好的表：(领域, 表对象id...) -> 表名，按最近使用排序；相同的表集合不重复建表
+            self._local.table_names = OrderedDict()
+            self._local.table_seq = 0
+            self._local.current_table = None
+            with self._engines_lock:
+                self._engines.append(engine)
+        return engine
+
+    def close(self):
+        """关闭所有线程的 SQL 引擎，释放内存库中缓存的表"""
+        with self._engines_lock:
+            engines, self._engines = self._engines, []
+        for engine in engines:
+            engine.close()
+        self._local = threading.local()
 
     def validate_qas(self, cache_manager: QACacheManager, dataset: ConversationDataset, is_step: bool):
         """
@@ -358,58 +1389,81 @@ class BatchValidator:
             print("\n--- Step-by-step mode: QA Validation Preview. ---")
             print(f"\n您可以检查缓存文件 {cache_manager.current_cache_path} ，然后按回车键继续...")
             input("Press Enter to continue...")
-            cache_manager.load_cache() # Reload cache before validation step
+            cache_manager.load_cache_if_changed() # Reload cache before validation step
         # Get all generated/liked QAs that haven't been successfully SQL verified
         qas_to_validate = [
             qa for qa in cache_manager.get_exportable_qas()
             if qa.get("sql_info", {}).get("sql_status") not in {"match","evidence_not_match"}
         ]
+        # 相同对话、相同会话的QA排在一起，连续校验时可复用已载入的 unified_data 表（见 _load_tables）
+        qas_to_validate.sort(key=_validation_group_key)
         self.logger.info(f"Found {len(qas_to_validate)} QAs to validate.")
+        # 对话id -> {会话id: 会话}，每个QA按id直接取会话，不再逐个扫描对话和会话列表
+        sessions_by_conv = {conv.id: {s.id: s for s in conv.sessions} for conv in dataset.conversations}
 
-        for qa_item in qas_to_validate:
-            question = qa_item.get("question_text")
-            answer_llm = qa_item.get("answer_text")
-            evidence_llm = qa_item.get("evidence", [])
-            sql_answer_query = qa_item["sql_info"].get("sql_answer_query", "")
-            sql_evidence_query = qa_item["sql_info"].get("sql_evidence_query", "")
-            conversation_id = qa_item.get("conversation_id")
-            session_ids = qa_item.get("session_ids")
-
-            if not all([question, answer_llm, evidence_llm, conversation_id, session_ids]):
-                self.logger.warning(f"Skipping malformed QA item: {qa_item.get('qa_id')}")
-                sql_info = {"sql_status": "skipped", "sql_error": "malformed_qa"}
+        try:
+            if self.max_workers > 1:
+                # 相同对话、相同会话的QA为一组交给同一线程，组内连续校验可复用该线程已载入的表
+                groups = [list(group) for _, group in groupby(qas_to_validate, key=_validation_group_key)]
+                with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                    for results in executor.map(self._validate_group, groups, repeat(sessions_by_conv)):
+                        for qa_item, sql_info in results:
+                            self._record_result(cache_manager, qa_item, sql_info)
             else:
-                # Find the relevant sessions from the dataset
-                relevant_conversation = next((conv for conv in dataset.conversations if conv.id == conversation_id), None)
-                if not relevant_conversation:
-                    self.logger.warning(f"Conversation {conversation_id} not found for QA {qa_item.get('qa_id')}. Skipping validation.")
-                    cache_manager.add_qa(qa_item, status=qa_item.get("status"), sql_info={"sql_status": "skipped", "sql_error": "no conversation"})
-                    cache_manager.save_cache()
-                    continue
+                for qa_item in qas_to_validate:
+                    self._record_result(cache_manager, qa_item, self._validate_item(qa_item, sessions_by_conv))
+        finally:
+            self.close()
+        cache_manager.flush()
 
-                selected_sessions = [s for s in relevant_conversation.sessions if s.id in session_ids]
-                if not selected_sessions:
-                    self.logger.warning(f"Sessions {session_ids} not found for QA {qa_item.get('qa_id')}. Skipping validation.")
-                    cache_manager.add_qa(qa_item, status=qa_item.get("status"), sql_info={"sql_status": "skipped", "sql_error": "no sessions"})
-                    cache_manager.save_cache()
-                    continue
-                
-                self.logger.info(f"Validating QA: {qa_item.get('qa_id')}")
-
-                # Perform validation and correction
-                sql_info = self.validate_and_correct(
-                                        question=question,
-                                        answer_llm=answer_llm,
-                                        evidence_llm=evidence_llm,
-                                        sql_answer_query=sql_answer_query,
-                                        sql_evidence_query=sql_evidence_query,
-                                        sessions=selected_sessions
-                                    )
-            
-            # Update cache with validation results
-            cache_manager.add_qa(qa_item, status=qa_item.get("status"), sql_info = sql_info)
-            cache_manager.save_cache()
-            self.logger.info(f"QA {qa_item.get('qa_id')} validation complete. Status: {sql_info.get('sql_status')}")
+    def _record_result(self, cache_manager: QACacheManager, qa_item: Dict, sql_info: Dict):
+        """将校验结果写入缓存（只在调用 validate_qas 的线程中执行）"""
+        cache_manager.add_qa(qa_item, status=qa_item.get("status"), sql_info=sql_info)
+        # 每累计一批修改或间隔一段时间才写盘，不再每个QA都重写整个缓存文件
+        cache_manager.maybe_flush()
+        self.logger.info(f"QA {qa_item.get('qa_id')} validation complete. Status: {sql_info.get('sql_status')}")
+
+    def _validate_group(self, qa_items: List[Dict], sessions_by_conv: Dict[str, Dict[str, Session]]) -> List[Tuple[Dict, Dict]]:
+        """在工作线程中依次校验一组QA，返回 (QA, 校验结果) 列表"""
+        return [(qa_item, self._validate_item(qa_item, sessions_by_conv)) for qa_item in qa_items]
+
+    def _validate_item(self, qa_item: Dict, sessions_by_conv: Dict[str, Dict[str, Session]]) -> Dict:
+        """校验单个QA，返回要写入缓存的 sql_info（不修改缓存，可在工作线程中执行）"""
+        question = qa_item.get("question_text")
+        answer_llm = qa_item.get("answer_text")
+        evidence_llm = qa_item.get("evidence", [])
+        sql_answer_query = qa_item["sql_info"].get("sql_answer_query", "")
+        sql_evidence_query = qa_item["sql_info"].get("sql_evidence_query", "")
+        conversation_id = qa_item.get("conversation_id")
+        session_ids = qa_item.get("session_ids")
+
+        if not all([question, answer_llm, evidence_llm, conversation_id, session_ids]):
+            self.logger.warning(f"Skipping malformed QA item: {qa_item.get('qa_id')}")
+            return {"sql_status": "skipped", "sql_error": "malformed_qa"}
+
+        # Find the relevant sessions from the dataset
+        sessions_by_id = sessions_by_conv.get(conversation_id)
+        if sessions_by_id is None:
+            self.logger.warning(f"Conversation {conversation_id} not found for QA {qa_item.get('qa_id')}. Skipping validation.")
+            return {"sql_status": "skipped", "sql_error": "no conversation"}
+
+        # 按 session_ids 的顺序（即生成时提示中会话的顺序）取会话
+        selected_sessions = [sessions_by_id[sid] for sid in session_ids if sid in sessions_by_id]
+        if not selected_sessions:
+            self.logger.warning(f"Sessions {session_ids} not found for QA {qa_item.get('qa_id')}. Skipping validation.")
+            return {"sql_status": "skipped", "sql_error": "no sessions"}
+
+        self.logger.info(f"Validating QA: {qa_item.get('qa_id')}")
+
+        # Perform validation and correction
+        return self.validate_and_correct(
+            question=question,
+            answer_llm=answer_llm,
+            evidence_llm=evidence_llm,
+            sql_answer_query=sql_answer_query,
+            sql_evidence_query=sql_evidence_query,
+            sessions=selected_sessions
+        )
 
     def validate_and_correct(self, question: str, answer_llm: Any, evidence_llm: List[Dict],
                              sql_answer_query: str, sql_evidence_query: str,
@@ -417,14 +1471,9 @@ class BatchValidator:
         """
         执行验证：LLM生成的SQL查询与数据库结果对比。
         """
-        result = {
-            "sql_status": None,
-            "sql_answer_query": sql_answer_query,
-            "sql_evidence_query": sql_evidence_query,
-            "sql_answer": None,
-            "sql_evidence": None,
-            "error": None
-        }
+        result = _SQL_RESULT_TEMPLATE.copy()
+        result["sql_answer_query"] = sql_answer_query
+        result["sql_evidence_query"] = sql_evidence_query
         
         tables = []
         for session in sessions:
@@ -438,7 +1487,7 @@ class BatchValidator:
         try:
             # 创建统一表
             self.logger.debug(f"###TableSample###:{tables[0]}")
-            self.sql_engine.create_table_from_struct(tables, domain=self.domain)
+            self._load_tables(tables)
             
             if not sql_answer_query or not sql_evidence_query:
                 self.logger.warning("Missing pre-generated SQL queries, skipping validation.")
@@ -476,59 +1525,38 @@ class BatchValidator:
         
         return result
 
-    def _generate_sql_prompt(self, question: str, domain: str) -> str:
-        """根据领域生成SQL提示"""
-        if domain == "financial":
-            return f"""
-            ### Financial SQL Generation
-            You are a financial SQL expert. Generate two SQL queries for the following question:
-            Question: {question}
-            
-            Database Schema:
-            Table: unified_data
-            Columns: code (TEXT), sname (TEXT), tdate (TEXT), value (REAL), metric (TEXT)
-            
-            Requirements:
-            1. First query (SQL_ANSWER): Calculate the answer to the question.
-            2. Second query (SQL_EVIDENCE): Retrieve all evidence rows used in the calculation.
-            3. Output both queries in the format:
-                SQL_ANSWER: [query];
-                SQL_EVIDENCE: [query];
-            """
-        elif domain == "medical":
-            return f"""
-            ### Medical SQL Generation
-            You are a medical SQL expert. Generate two SQL queries for the following question:
-            Question: {question}
-            
-            Database Schema:
-            Table: unified_data
-            Columns: PatientID (TEXT), time_event (TEXT), variable_name (TEXT), value (REAL), table_type (TEXT)
-            
-            Requirements:
-            1. First query (SQL_ANSWER): Calculate the answer to the question.
-            2. Second query (SQL_EVIDENCE): Retrieve all evidence rows used in the calculation.
-            3. Output both queries in the format:
-                SQL_ANSWER: [query];
-                SQL_EVIDENCE: [query];
-            """
+    def _load_tables(self, tables: List[Table]):
+        """
+        将表格载入 unified_data；同一组表（同一对话中选到相同会话）只建一次表，之后切换视图即可复用。
+        表对象在整个校验过程中都由数据集持有，id 不会被复用；顺序不同时重新建表，保证行的插入顺序一致。
+        每个线程最多保留 _SQL_TABLE_CACHE_SIZE 张表，超出时删除最久未用的表。
+        """
+        sql_engine = self.sql_engine
+        table_names = self._local.table_names
+        tables_key = (self.domain, *map(id, tables))
+        table_name = table_names.get(tables_key)
+        if table_name is not None:
+            table_names.move_to_end(tables_key)
+            if table_name == self._local.current_table:
+                self.logger.debug("Reusing unified_data table loaded for the previous QA")
+                return
+            self.logger.debug(f"Reusing cached table {table_name} for unified_data")
         else:
-            return f"""
-            ### Generic SQL Generation
-            Generate two SQL queries for the following question:
-            Question: {question}
-            
-            Database Schema:
-            Table: unified_data
-            Columns: entity_id (TEXT), timestamp (TEXT), variable_name (TEXT), value (REAL), table_type (TEXT)
-            
-            Requirements:
-            1. First query (SQL_ANSWER): Calculate the answer to the question.
-            2. Second query (SQL_EVIDENCE): Retrieve all evidence rows used in the calculation.
-            3. Output both queries in the format:
-                SQL_ANSWER: [query];
-                SQL_EVIDENCE: [query];
-            """
+            table_name = f"unified_{self._local.table_seq}"
+            self._local.table_seq += 1
+            sql_engine.create_table_from_struct(tables, domain=self.domain, table_name=table_name)
+            table_names[tables_key] = table_name
+            if len(table_names) > _SQL_TABLE_CACHE_SIZE:
+                _, evicted = table_names.popitem(last=False)
+                sql_engine.drop_tables([evicted])
+        # 切换失败时视图指向不确定，先清除记录
+        self._local.current_table = None
+        sql_engine.use_table(table_name)
+        self._local.current_table = table_name
+
+    def _generate_sql_prompt(self, question: str, domain: str) -> str:
+        """根据领域生成SQL提示（模板见 _SQL_PROMPT_TEMPLATES）"""
+        return _SQL_PROMPT_TEMPLATES.get(domain, _GENERIC_SQL_PROMPT_TEMPLATE).format(question=question)
 
     def _generate_sql_from_llm(self, prompt: str) -> str:
         """使用LLM生成双查询SQL语句"""
@@ -551,8 +1579,8 @@ class BatchValidator:
     def _parse_double_query(self, full_sql: str) -> Tuple[str, str]:
         """解析LLM生成的包含SQL_ANSWER和SQL_EVIDENCE的双查询字符串"""
         # 尝试解析标准格式
-        answer_match = re.search(r'SQL_ANSWER:\s*(.*?)(?=SQL_EVIDENCE:|$)', full_sql, re.DOTALL | re.IGNORECASE)
-        evidence_match = re.search(r'SQL_EVIDENCE:\s*(.*)', full_sql, re.DOTALL | re.IGNORECASE)
+        answer_match = _SQL_ANSWER_RE.search(full_sql)
+        evidence_match = _SQL_EVIDENCE_RE.search(full_sql)
         
         if answer_match and evidence_match:
             return self._clean_sql(answer_match.group(1)), self._clean_sql(evidence_match.group(1))
@@ -568,7 +1596,7 @@ class BatchValidator:
 
     def _clean_sql(self, sql_string: str) -> str:
         """清理SQL字符串，移除Markdown代码块标记和多余空格"""
-        cleaned = re.sub(r'^\s*```(?:sql)?\s*|\s*```\s*$', '', sql_string, flags=re.IGNORECASE)
+        cleaned = _SQL_FENCE_RE.sub('', sql_string)
         return cleaned.strip()
 
 def main():
@@ -585,6 +1613,8 @@ def main():
         # Load data
         dataset = load_data(args.input_data)
         logger.info(f"数据集包含 {len(dataset.conversations)} 个对话")
+        # 数据集在整个运行期间只读，移入永久代，之后的垃圾回收不再反复扫描这些对象
+        gc.freeze()
         
         difficulty_counts: Dict[DifficultyLevel, int] = {
             "easy": args.easy,
@@ -608,14 +1638,42 @@ def main():
             max_disliked_examples=args.max_disliked_examples,
             cache_dir=args.cache_dir,
             domain=args.domain,
+            max_concurrency=args.max_concurrency,
+            qpm=args.qpm,
+            tpm=args.tpm,
+            use_prompt_cache_key=args.use_prompt_cache_key,
+            save_every=args.save_every,
+            use_batch_api=args.use_batch_api,
+            batch_poll_interval=args.batch_poll_interval,
+            render_workers=args.render_workers,
+            enable_thinking=not args.disable_thinking,
+            seed=args.seed,
+            num_workers=args.num_workers,
+            use_response_cache=args.use_response_cache,
+            table_type_in_header=args.table_type_in_header,
+            temperature=args.temperature,
+            response_cache_match=args.response_cache_match,
+            context_last=args.context_last,
+            samples_per_request=args.samples_per_request,
+            append_cache_log=args.append_cache_log,
+            cache_format=args.cache_format,
+            request_timeout=args.request_timeout,
+            model_by_difficulty={"easy": args.easy_model, "medium": args.medium_model, "hard": args.hard_model},
         )
+        # 缓存采用批量写盘，进程异常退出（如 Ctrl+C）时也保存尚未写盘的修改
+        atexit.register(qa_generator.cache_manager.flush)
         
-        qa_generator.batch_generate(dataset, difficulty_counts) 
+        # 生成过程中逐条写出 JSON Lines，进程中断时已生成的QA也不会丢失
+        os.makedirs(args.output_dir, exist_ok=True)
+        input_name = os.path.splitext(os.path.basename(args.input_data))[0]
+        stream_path = os.path.join(args.output_dir, f"{input_name}_qas_generated.jsonl")
+        qa_generator.batch_generate(dataset, difficulty_counts, output_path=stream_path)
+        logger.info(f"生成过程中的QA已流式写入: {stream_path}")
 
         # --- Second Stage: Validation (Optional) ---
         if args.enable_validation:
             logger.info("Enabling QA validation process.")
-            batch_validator = BatchValidator(model=args.model, domain=args.domain)
+            batch_validator = BatchValidator(model=args.model, domain=args.domain, max_workers=args.validate_workers)
             batch_validator.validate_qas(qa_generator.cache_manager, dataset, args.is_step)
             logger.info("QA validation process completed.")
 
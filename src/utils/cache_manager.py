@@ -1,15 +1,35 @@
 import json
 import os
 import time
+import random
 import hashlib
+import threading
 import logging
 from abc import ABC, abstractmethod
+from collections import Counter, defaultdict
 from typing import List, Dict, Any, Literal, Tuple
 from pathlib import Path
+from .json_utils import dump_json, dump_jsonl, dumps_json, iter_json_records, load_json
 # Common Difficulty Level type
 DifficultyLevel = Literal["easy", "medium", "hard"]
 
 
+def _sample_k(pool: List[Dict], k: int, rng=None) -> List[Dict]:
+    """
+    从 pool 中不放回地随机抽取至多 k 个元素，结果顺序不固定。
+    k 很小（示例数通常为 3）而 pool 可能有上千个时，随机抽下标并拒绝重复，耗时只与 k 有关。
+    rng 为抽样使用的随机数生成器（random.Random 或 random 模块），默认使用全局 random。
+    """
+    n = len(pool)
+    if n <= k:
+        return list(pool)
+    rng = rng or random
+    indices = set()
+    while len(indices) < k:
+        indices.add(rng.randrange(n))
+    return [pool[i] for i in indices]
+
+
 class BaseCacheManager(ABC):
     """
     基类缓存管理器，提供通用的缓存加载、保存和路径管理功能
@@ -44,11 +64,10 @@ class BaseCacheManager(ABC):
         
         if self.current_cache_path.exists():
             try:
-                with open(self.current_cache_path, 'r', encoding='utf-8') as f:
-                    self.cache_data = json.load(f)
-                    self.logger.info(f"Loaded cache from {self.current_cache_path}")
+                self.cache_data = self._read_cache_file(self.current_cache_path)
+                self.logger.info(f"Loaded cache from {self.current_cache_path}")
                 return True
-            except json.JSONDecodeError as e:
+            except json.JSONDecodeError as e:  # orjson 的解析错误也是其子类
                 self.logger.warning(f"Error loading cache from {self.current_cache_path}: {e}. Initializing empty cache.")
                 self.cache_data = self._initialize_empty_cache_data()
                 return False
@@ -57,12 +76,15 @@ class BaseCacheManager(ABC):
             self.cache_data = self._initialize_empty_cache_data()
             return True
 
+    def _read_cache_file(self, path: Path) -> Dict:
+        """读取缓存文件，子类可覆盖以使用其他文件格式"""
+        return load_json(path)
+
     def save_cache(self):
         """保存当前缓存数据到文件"""
         if self.current_cache_path:
             try:
-                with open(self.current_cache_path, 'w', encoding='utf-8') as f:
-                    json.dump(self.cache_data, f, indent=2, ensure_ascii=False)
+                dump_json(self.cache_data, self.current_cache_path, durable=True)
                 self.logger.info(f"Cache saved to {self.current_cache_path}")
             except Exception as e:
                 self.logger.error(f"Failed to save cache to {self.current_cache_path}: {e}")
@@ -81,15 +103,181 @@ class QACacheManager(BaseCacheManager):
     QA 生成的缓存管理器
     缓存包含统一的 QA 列表，每个 QA 包含状态标签 (status: "liked", "generated", "disliked")
     使用单一全局缓存文件来存储所有生成的QA，实现断点恢复和偏好管理。
+    add_qa、计数、示例抽样与保存在内部加锁，可在多个线程间共享。
+    append_log=True 时每次 add_qa 把修改后的QA追加到日志文件（JSON Lines），缓存文件只在日志积累到
+    compact_every 条或结束时整体重写（压缩），重写成功后清空日志；加载时将日志中的记录按 qa_id 合并到缓存。
+    cache_format="jsonl" 时缓存文件为 qa_cache.jsonl，每行一个QA，不缩进、逐行序列化；
+    该文件不存在而存在旧的 qa_cache.json 时从后者加载一次，之后改写为 JSON Lines。
     """
-    def __init__(self, cache_dir: str = "./qa_generation_cache"):
+    def __init__(self, cache_dir: str = "./qa_generation_cache", append_log: bool = False,
+                 compact_every: int = 1000, cache_format: Literal["json", "jsonl"] = "json"):
+        self.cache_format = cache_format
         super().__init__(cache_dir)
         self.logger = logging.getLogger(self.__class__.__name__)
+        # (conversation_id, difficulty, status) -> QA 数量，随 add_qa 增量维护
+        self._status_counts: Counter = Counter()
+        # (status, difficulty) -> QA 列表，用于按状态和难度抽样示例而不扫描整个缓存
+        self._status_buckets: Dict[Tuple[str, str], List[Dict]] = defaultdict(list)
+        self._bucket_pos: Dict[int, int] = {}  # id(qa) -> 在所属列表中的位置，用于 O(1) 移除
+        self._qa_by_id: Dict[str, Dict] = {}  # qa_id -> QA，add_qa 和 get_qa_by_id 直接查找
+        # 缓存内容版本号：加载或 add_qa 修改缓存时加 1，调用方可据此判断基于缓存的派生结果是否过期
+        self.version = 0
+        self._status_list_memo: Dict[str, Tuple[int, List[Dict]]] = {}  # status -> (version, 不分难度的QA列表)
+        # 生成线程读取示例、主线程写入QA，修改缓存和读取索引时加锁
+        self._lock = threading.RLock()
+        # 上次成功写盘后修改过的QA数和写盘时间，用于 maybe_flush 批量写盘
+        self._dirty_count = 0
+        self._last_flush = time.monotonic()
+        self._file_stamp = None  # 最近一次读写后缓存文件的 (st_mtime_ns, st_size)
+        self.append_log = append_log
+        self.compact_every = max(1, compact_every)
+        self._log_path = self.cache_dir / "qa_cache.log.jsonl"
+        self._log_file = None  # 追加日志的文件句柄，首次追加时打开
         self.load_cache()
         
     def _generate_cache_key(self, *args, **kwargs) -> str:
         return "qa_cache"
 
+    def _get_cache_file_path(self, cache_key: str) -> Path:
+        if self.cache_format == "jsonl":
+            return self.cache_dir / f"{cache_key}.jsonl"
+        return super()._get_cache_file_path(cache_key)
+
+    def _read_cache_file(self, path: Path) -> Dict:
+        if self.cache_format == "jsonl":
+            return {"questions": list(iter_json_records(str(path)))}
+        return super()._read_cache_file(path)
+
+    def load_cache(self, *args, **kwargs) -> bool:
+        """加载缓存后重建计数索引（缓存文件可能在外部被修改）"""
+        with self._lock:
+            loaded = super().load_cache(*args, **kwargs)
+            migrated = self._load_legacy_cache()
+            # 未开启 append_log 时也合并上次运行遗留的日志
+            replayed = self._replay_log()
+            self._rebuild_index()
+            self._mark_flushed()
+            self._file_stamp = self._stat_cache_file()
+            if replayed:
+                self.logger.info(f"Replayed {replayed} QA records from {self._log_path}")
+            if replayed or migrated:
+                # 日志中的修改已合并（或旧格式缓存已读入），重写缓存文件并清空日志
+                self.save_cache()
+            return loaded
+
+    def _load_legacy_cache(self) -> bool:
+        """cache_format="jsonl" 且尚无 JSON Lines 缓存时，读取同目录下旧的 JSON 缓存文件，返回是否读取"""
+        if self.cache_format != "jsonl" or self.current_cache_path.exists():
+            return False
+        legacy_path = self.current_cache_path.with_suffix(".json")
+        if not legacy_path.exists():
+            return False
+        try:
+            self.cache_data = load_json(legacy_path)
+        except json.JSONDecodeError as e:
+            self.logger.warning(f"Error loading legacy cache from {legacy_path}: {e}. Ignoring it.")
+            return False
+        self.logger.info(f"Loaded legacy cache from {legacy_path}; it will be rewritten to {self.current_cache_path}")
+        return True
+
+    def _replay_log(self) -> int:
+        """将追加日志中的QA记录按 qa_id 合并到缓存数据（同一QA以最后一条为准），返回记录数"""
+        if not self._log_path.exists():
+            return 0
+        questions = self.cache_data.setdefault("questions", [])
+        by_id = {qa.get("qa_id"): qa for qa in questions}
+        replayed = 0
+        try:
+            for record in iter_json_records(str(self._log_path)):
+                existing = by_id.get(record["qa_id"])
+                if existing is not None:
+                    existing.update(record)
+                else:
+                    questions.append(record)
+                    by_id[record["qa_id"]] = record
+                replayed += 1
+        except json.JSONDecodeError as e:
+            # 进程中断时最后一行可能只写了一半，之前的记录仍然有效
+            self.logger.warning(f"Stopped replaying {self._log_path} at a malformed record: {e}")
+        return replayed
+
+    def _append_to_log(self, qa: Dict):
+        """把QA的当前内容追加到日志文件（调用方持有 self._lock）"""
+        if self._log_file is None:
+            self._log_file = open(self._log_path, 'a', encoding='utf-8')
+        self._log_file.write(dumps_json(qa) + "\n")
+        self._log_file.flush()
+
+    def _truncate_log(self):
+        """缓存文件已包含日志中的全部修改，清空日志（调用方持有 self._lock）"""
+        if self._log_file is not None:
+            self._log_file.close()
+            self._log_file = None
+        if self._log_path.exists():
+            os.remove(self._log_path)
+
+    def load_cache_if_changed(self) -> bool:
+        """
+        缓存文件在上次读写后被外部修改过（修改时间或大小变化）时才重新加载，
+        用于逐步模式下等待用户检查缓存文件之后。返回是否重新加载。
+        """
+        if self.current_cache_path is not None and self._stat_cache_file() == self._file_stamp:
+            self.logger.info(f"Cache file {self.current_cache_path} unchanged, skip reloading.")
+            return False
+        self.load_cache()
+        return True
+
+    def _stat_cache_file(self) -> Tuple[int, int] | None:
+        try:
+            stat = os.stat(self.current_cache_path)
+        except (OSError, TypeError):
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _rebuild_index(self):
+        """根据当前缓存数据重建计数索引和 (status, difficulty) 分桶"""
+        self._status_counts = Counter()
+        self._status_buckets = defaultdict(list)
+        self._bucket_pos = {}
+        self._qa_by_id = {}
+        self.version += 1
+        for qa in self.cache_data.get("questions", []):
+            self._index_add(qa)
+
+    def _index_add(self, qa: Dict):
+        """将QA按其当前状态加入计数和分桶"""
+        # 缓存文件中 qa_id 重复时以第一个为准（与原先按列表顺序查找一致）
+        self._qa_by_id.setdefault(qa.get("qa_id"), qa)
+        self._status_counts[(qa.get("conversation_id"), qa.get("difficulty"), qa.get("status"))] += 1
+        bucket = self._status_buckets[(qa.get("status"), qa.get("difficulty"))]
+        self._bucket_pos[id(qa)] = len(bucket)
+        bucket.append(qa)
+
+    def _index_remove(self, qa: Dict):
+        """将QA从其当前状态的计数和分桶中移除（与末尾元素交换后弹出，O(1)）"""
+        self._status_counts[(qa.get("conversation_id"), qa.get("difficulty"), qa.get("status"))] -= 1
+        bucket = self._status_buckets[(qa.get("status"), qa.get("difficulty"))]
+        pos = self._bucket_pos.pop(id(qa))
+        last = bucket.pop()
+        if last is not qa:
+            bucket[pos] = last
+            self._bucket_pos[id(last)] = pos
+
+    def count(self, conversation_id: str, difficulty: DifficultyLevel,
+              statuses: Tuple[str, ...] = ("liked", "generated")) -> int:
+        """统计某个对话在某难度下处于给定状态的QA数量，O(1) 查询计数索引"""
+        with self._lock:
+            return sum(self._status_counts[(conversation_id, difficulty, status)] for status in statuses)
+
+    def count_by_status(self, statuses: Tuple[str, ...] = ("liked", "generated"),
+                        difficulty: DifficultyLevel = None) -> int:
+        """统计处于给定状态的QA总数（可按难度过滤），直接累加 (状态, 难度) 分桶的长度，不扫描整个缓存"""
+        with self._lock:
+            return sum(
+                len(bucket) for (status, bucket_difficulty), bucket in self._status_buckets.items()
+                if status in statuses and (difficulty is None or bucket_difficulty == difficulty)
+            )
+
     def _initialize_empty_cache_data(self) -> Dict:
         return {
             "questions": []
@@ -109,60 +297,85 @@ class QACacheManager(BaseCacheManager):
             sql_status: match / skipped / *_not_match / not yet / failed
         优先保留 'liked' 或 'disliked' 状态，不被 'generated' 覆盖。
         """
-        qa_id = qa_pair.get("qa_id")
-        if not qa_id:
-            qa_id = self.generate_qa_id(qa_pair)
-            qa_pair["qa_id"] = qa_id
-
-        existing_qa_index = -1
-        for i, q in enumerate(self.cache_data["questions"]):
-            if q.get("qa_id") == qa_id:
-                existing_qa_index = i
-                break
-
-        qa_data_to_store = {
-            "qa_id": qa_id,
-            "question_text": qa_pair.get("question_text"),
-            "answer_text": qa_pair.get("answer_text"),
-            "evidence": qa_pair.get("evidence"),
-            "conversation_id": qa_pair.get("conversation_id"),
-            "session_ids": qa_pair.get("session_ids"),
-            "timestamp": qa_pair.get("timestamp", time.strftime("%Y-%m-%dT%H:%M:%S")),
-            "difficulty": qa_pair.get("difficulty"),
-            "status": status,
-            "sql_info": sql_info
-        }
+        with self._lock:
+            qa_id = qa_pair.get("qa_id")
+            if not qa_id:
+                qa_id = self.generate_qa_id(qa_pair)
+                qa_pair["qa_id"] = qa_id
+
+            existing_qa = self._qa_by_id.get(qa_id)
+
+            qa_data_to_store = {
+                "qa_id": qa_id,
+                "question_text": qa_pair.get("question_text"),
+                "answer_text": qa_pair.get("answer_text"),
+                "evidence": qa_pair.get("evidence"),
+                "conversation_id": qa_pair.get("conversation_id"),
+                "session_ids": qa_pair.get("session_ids"),
+                "timestamp": qa_pair.get("timestamp", time.strftime("%Y-%m-%dT%H:%M:%S")),
+                "difficulty": qa_pair.get("difficulty"),
+                "status": status,
+                "sql_info": sql_info
+            }
 
-        if existing_qa_index != -1:
-            # Check existing status priority
-            current_status = self.cache_data["questions"][existing_qa_index].get("status")
-            if (current_status == "liked" and status != "liked") or \
-               (current_status == "disliked" and status not in ["liked", "disliked"]):
-                self.logger.debug(f"Skipped updating QA {qa_id}: new status '{status}' is lower priority than existing '{current_status}'")
-                return False # Don't overwrite higher priority status
+            if existing_qa is not None:
+                # Check existing status priority
+                current_status = existing_qa.get("status")
+                if (current_status == "liked" and status != "liked") or \
+                   (current_status == "disliked" and status not in ["liked", "disliked"]):
+                    self.logger.debug(f"Skipped updating QA {qa_id}: new status '{status}' is lower priority than existing '{current_status}'")
+                    return False # Don't overwrite higher priority status
             
-            # Update existing QA
-            self.cache_data["questions"][existing_qa_index].update(qa_data_to_store)
-            self.logger.debug(f"Updated existing QA in cache: {qa_id} (status: {status})")
-            return False # Not a new addition
-        else:
-            self.cache_data["questions"].append(qa_data_to_store)
-            self.logger.debug(f"Added new QA to cache: {qa_id} (status: {status})")
-            return True # A new addition
+                # Update existing QA
+                self._index_remove(existing_qa)
+                existing_qa.update(qa_data_to_store)
+                self._index_add(existing_qa)
+                if self.append_log:
+                    self._append_to_log(existing_qa)
+                self._dirty_count += 1
+                self.version += 1
+                self.logger.debug(f"Updated existing QA in cache: {qa_id} (status: {status})")
+                return False # Not a new addition
+            else:
+                self.cache_data["questions"].append(qa_data_to_store)
+                self._index_add(qa_data_to_store)
+                if self.append_log:
+                    self._append_to_log(qa_data_to_store)
+                self._dirty_count += 1
+                self.version += 1
+                self.logger.debug(f"Added new QA to cache: {qa_id} (status: {status})")
+                return True # A new addition
 
-    def get_preferred_qas(self, difficulty: DifficultyLevel = None) -> List[Dict]:
-        """获取所有被标记为“liked”的QA列表，可按难度过滤。"""
-        preferred_qas = [qa for qa in self.cache_data.get("questions", []) if qa.get("status") == "liked"]
-        if difficulty:
-            return [qa for qa in preferred_qas if qa.get("difficulty") == difficulty]
-        return preferred_qas
+    def _get_qas_by_status(self, status: str, difficulty: DifficultyLevel = None, k: int | None = None,
+                           rng=None) -> List[Dict]:
+        """
+        获取指定状态的QA列表，可按难度过滤。
+        指定 k 时用 rng（默认全局 random）从对应分桶中随机抽取至多 k 个，只访问该分桶，不扫描整个缓存；
+        抽样按下标进行（见 _sample_k），不复制分桶。
+        不分难度时按缓存顺序扫描一次，结果按版本号缓存，缓存未修改时不再重复扫描。
+        """
+        with self._lock:
+            if difficulty:
+                qas = self._status_buckets.get((status, difficulty), [])
+            else:
+                memo = self._status_list_memo.get(status)
+                if memo is None or memo[0] != self.version:
+                    memo = self._status_list_memo[status] = (
+                        self.version,
+                        [qa for qa in self.cache_data.get("questions", []) if qa.get("status") == status]
+                    )
+                qas = memo[1]
+            if k is None:
+                return list(qas)
+            return _sample_k(qas, k, rng)
+
+    def get_preferred_qas(self, difficulty: DifficultyLevel = None, k: int | None = None, rng=None) -> List[Dict]:
+        """获取被标记为“liked”的QA列表，可按难度过滤；指定 k 时用 rng（默认全局 random）随机抽取至多 k 个。"""
+        return self._get_qas_by_status("liked", difficulty, k, rng)
     
-    def get_disliked_qas(self, difficulty: DifficultyLevel = None) -> List[Dict]:
-        """获取所有被标记为“disliked”的QA列表，可按难度过滤。"""
-        disliked_qas = [qa for qa in self.cache_data.get("questions", []) if qa.get("status") == "disliked"]
-        if difficulty:
-            return [qa for qa in disliked_qas if qa.get("difficulty") == difficulty]
-        return disliked_qas
+    def get_disliked_qas(self, difficulty: DifficultyLevel = None, k: int | None = None, rng=None) -> List[Dict]:
+        """获取被标记为“disliked”的QA列表，可按难度过滤；指定 k 时用 rng（默认全局 random）随机抽取至多 k 个。"""
+        return self._get_qas_by_status("disliked", difficulty, k, rng)
 
     def get_all_questions_text(self, difficulty: DifficultyLevel = None) -> List[str]:
         """
@@ -197,11 +410,8 @@ class QACacheManager(BaseCacheManager):
 
     def get_qa_by_id(self, qa_id: str) -> Dict | None:
         """根据QA ID获取特定的QA对"""
-        for qa in self.cache_data.get("questions", []):
-            if qa.get("qa_id") == qa_id:
-                return qa
-        return None
-    
+        return self._qa_by_id.get(qa_id)
+
     def save_cache(self):
         """
         保存当前缓存数据到文件，并在保存前对所有问题按 difficulty 排序：
@@ -209,20 +419,60 @@ class QACacheManager(BaseCacheManager):
         if not self.current_cache_path:
             self.logger.warning("No current cache path set. Cannot save cache.")
             return
+        with self._lock:
+            self._sort_questions()
+            try:
+                if self.cache_format == "jsonl":
+                    dump_jsonl(self.cache_data["questions"], str(self.current_cache_path), atomic=True, durable=True)
+                else:
+                    dump_json(self.cache_data, self.current_cache_path, durable=True)
+            except Exception as e:
+                self.logger.error(f"Failed to save cache to {self.current_cache_path}: {e}")
+                # 写盘失败时修改仍计为未写盘，留待下次保存，但不在之后每次修改时都立即重试
+                self._last_flush = time.monotonic()
+                return
+            self._file_stamp = self._stat_cache_file()
+            self._truncate_log()
+            self._mark_flushed()
+            self.logger.info(f"Cache (sorted by difficulty) saved to {self.current_cache_path}")
+
+    def maybe_flush(self, max_dirty: int = 50, max_interval: float = 30.0) -> bool:
+        """
+        有未写盘的修改，且累计达到 max_dirty 个或距上次写盘超过 max_interval 秒时才保存缓存，
+        避免每次修改都重写整个缓存文件。返回是否保存。
+        append_log 时修改已逐条写入日志，只在日志达到 compact_every 条时压缩。
+        """
+        with self._lock:
+            if self.append_log:
+                if self._dirty_count < self.compact_every:
+                    return False
+                self.save_cache()
+                return True
+            if not self._dirty_count:
+                return False
+            if self._dirty_count < max_dirty and time.monotonic() - self._last_flush < max_interval:
+                return False
+            self.save_cache()
+            return True
+
+    def flush(self):
+        """有未写盘的修改时立即保存缓存（用于结束或退出时）"""
+        with self._lock:
+            if self._dirty_count:
+                self.save_cache()
 
+    def _mark_flushed(self):
+        self._dirty_count = 0
+        self._last_flush = time.monotonic()
+
+    def _sort_questions(self):
         difficulty_rank = {"hard": 2, "medium": 1, "easy": 0}
-        try:
-            self.cache_data["questions"].sort(
-                key=lambda q: (
-                    difficulty_rank.get(q.get("difficulty", "easy"), 3),
-                    q.get("timestamp", "")
-                )
+        self.cache_data["questions"].sort(
+            key=lambda q: (
+                difficulty_rank.get(q.get("difficulty", "easy"), 3),
+                q.get("timestamp", "")
             )
-            with open(self.current_cache_path, 'w', encoding='utf-8') as f:
-                json.dump(self.cache_data, f, indent=2, ensure_ascii=False)
-            self.logger.info(f"Cache (sorted by difficulty) saved to {self.current_cache_path}")
-        except Exception as e:
-            self.logger.error(f"Failed to save cache to {self.current_cache_path}: {e}")
+        )
 
 class DialogCacheManager(BaseCacheManager):
     """
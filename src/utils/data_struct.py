@@ -1,6 +1,7 @@
 # src/utils/data_struct.py
 
 from typing import List, Dict
+from .json_utils import dump_json, iter_json_records
 # 单个对话回合表示
 class DialogueTurn:
     def __init__(self, turn_id, speaker, content):
@@ -69,13 +70,10 @@ class ConversationDataset:
 
 def load_data(input_path: str) -> ConversationDataset:
     """加载并转换数据为ConversationDataset对象"""
-    import json
     try:
-        with open(input_path, 'r', encoding='utf-8') as f:
-            raw_data = json.load(f)
-        
         conversations = []
-        for conv_data in raw_data:
+        # .jsonl 输入按行流式读取，每行一个对话
+        for conv_data in iter_json_records(input_path):
             sessions = []
             for session_data in conv_data.get("sessions", []):
                 turns = []
@@ -118,10 +116,8 @@ def load_data(input_path: str) -> ConversationDataset:
         
 def save_results(results: List[Dict], output_path: str):
     """保存生成的QA对结果"""
-    import json
     try:
-        with open(output_path, 'w', encoding='utf-8') as f:
-            json.dump(results, f, indent=2, ensure_ascii=False)
+        dump_json(results, output_path)
         print(f"成功保存 {len(results)} 条QA对至: {output_path}")
     except Exception as e:
         raise Exception(f"保存结果到 {output_path} 时出错: {e}") from e
@@ -0,0 +1,96 @@
+# src/utils/json_utils.py
+"""
+JSON 读写工具
+优先使用 orjson（C 实现，速度更快），未安装时回退到标准库 json
+"""
+import os
+import json
+from typing import Any, Iterable, Iterator
+
+try:
+    import orjson
+except ImportError:  # orjson 为可选依赖
+    orjson = None
+
+
+def dumps_json(obj: Any, indent: bool = False) -> str:
+    """序列化为 JSON 字符串（保留非 ASCII 字符）"""
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if indent else 0)
+        return orjson.dumps(obj, option=option).decode("utf-8")
+    return json.dumps(obj, indent=2 if indent else None, ensure_ascii=False)
+
+
+def loads_json(data: str | bytes) -> Any:
+    """从 JSON 字符串或字节解析对象"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dump_json(obj: Any, path: str, indent: bool = True, durable: bool = False):
+    """
+    将对象写入 JSON 文件（默认 2 空格缩进）
+    先写入同目录下的临时文件再原子替换，写到一半中断时原文件保持完整；
+    durable=True 时替换前 fsync，保证断电后文件内容也已落盘
+    """
+    tmp_path = f"{path}.tmp"
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if indent else 0)
+        with open(tmp_path, 'wb') as f:
+            f.write(orjson.dumps(obj, option=option))
+            if durable:
+                f.flush()
+                os.fsync(f.fileno())
+    else:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(obj, f, indent=2 if indent else None, ensure_ascii=False)
+            if durable:
+                f.flush()
+                os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def load_json(path: str) -> Any:
+    """读取 JSON 文件"""
+    if orjson is not None:
+        with open(path, 'rb') as f:
+            return orjson.loads(f.read())
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def dump_jsonl(records: Iterable[Any], path: str, atomic: bool = False, durable: bool = False) -> int:
+    """
+    逐条写入 JSON Lines 文件（每行一个对象），返回写入条数
+    atomic=True 时与 dump_json 相同，先写临时文件再原子替换；durable=True 时替换前 fsync
+    """
+    target_path = f"{path}.tmp" if atomic else path
+    count = 0
+    with open(target_path, 'wb') as f:
+        for record in records:
+            if orjson is not None:
+                f.write(orjson.dumps(record, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_APPEND_NEWLINE))
+            else:
+                f.write((json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8"))
+            count += 1
+        if durable:
+            f.flush()
+            os.fsync(f.fileno())
+    if atomic:
+        os.replace(target_path, path)
+    return count
+
+
+def iter_json_records(path: str) -> Iterator[Any]:
+    """
+    逐条读取数据文件中的记录
+    .jsonl 文件按行流式解析，其他文件视为顶层为列表的 JSON
+    """
+    if path.endswith(".jsonl"):
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    yield loads_json(line)
+    else:
+        yield from load_json(path)
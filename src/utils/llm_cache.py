@@ -0,0 +1,78 @@
+# src/utils/llm_cache.py
+"""
+LLM 回复缓存
+按 (模型, 消息, 请求参数) 的 sha256 精确匹配，回复以 JSON Lines 追加写入磁盘，
+进程中断后重新运行时，相同的请求直接使用缓存的回复而不再调用接口。
+"""
+import os
+import hashlib
+import logging
+import threading
+from collections import Counter, defaultdict
+from typing import Dict, List
+
+from .json_utils import dumps_json, iter_json_records
+
+logger = logging.getLogger(__name__)
+
+
+class LLMResponseCache:
+    """
+    精确匹配的回复缓存，可在多个线程间共享。
+    同一请求可以对应多条回复；每条回复在一次运行中只使用一次，按记录顺序依次返回，
+    用完后再次发出的相同请求（如解析失败或被拒绝后重试）会重新调用接口，避免重复得到同一个回复。
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._responses: Dict[str, List[str]] = defaultdict(list)
+        self._used: Counter = Counter()  # key -> 本次运行中已使用（或新记录）的回复数
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            for record in iter_json_records(path):
+                self._responses[record["key"]].append(record["response"])
+            logger.info(f"Loaded {sum(map(len, self._responses.values()))} cached LLM responses from {path}")
+
+    @staticmethod
+    def make_key(model: str, messages: List[Dict], extra_body: Dict) -> str:
+        """根据模型、消息和请求参数生成缓存键"""
+        payload = dumps_json({"model": model, "messages": messages, "extra_body": extra_body})
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        """返回本次运行中尚未使用过的缓存回复，没有时返回 None"""
+        with self._lock:
+            responses = self._responses.get(key, ())
+            if self._used[key] >= len(responses):
+                return None
+            self._used[key] += 1
+            return responses[self._used[key] - 1]
+
+    def set(self, key: str, response: str):
+        """记录一次新的回复并追加写入缓存文件"""
+        with self._lock:
+            # 只在 get 未命中（该键的缓存回复已用完）后调用，追加到末尾即与文件中的顺序一致
+            self._responses[key].append(response)
+            self._used[key] += 1
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(dumps_json({"key": key, "response": response}) + "\n")
+
+    def merge(self, path: str) -> int:
+        """
+        将另一个缓存文件（如子进程的回复缓存）中本缓存没有的记录追加到本缓存及其文件，返回追加的条数。
+        按 (键, 回复) 计数比较：对方文件中已在本缓存出现的份数（如从本缓存复制过去的部分）不重复追加。
+        """
+        with self._lock:
+            existing = Counter((key, response) for key, responses in self._responses.items() for response in responses)
+            new_records = []
+            for record in iter_json_records(path):
+                pair = (record["key"], record["response"])
+                if existing[pair]:
+                    existing[pair] -= 1
+                else:
+                    new_records.append(record)
+            if new_records:
+                with open(self.path, 'a', encoding='utf-8') as f:
+                    f.writelines(dumps_json({"key": r["key"], "response": r["response"]}) + "\n" for r in new_records)
+                for record in new_records:
+                    self._responses[record["key"]].append(record["response"])
+            return len(new_records)
@@ -70,6 +70,13 @@ def qa_generation_args(parser: argparse.ArgumentParser):
     parser.add_argument("--hard", type=int, default=0,
                         help="Number of 'hard' questions to generate for the entire dataset.")
 
+    parser.add_argument("--easy_model", type=str, default=None,
+                        help="Model used to generate 'easy' questions (default: --model), e.g. a smaller, faster model for short answers.")
+    parser.add_argument("--medium_model", type=str, default=None,
+                        help="Model used to generate 'medium' questions (default: --model).")
+    parser.add_argument("--hard_model", type=str, default=None,
+                        help="Model used to generate 'hard' questions (default: --model).")
+
     # Interaction and Guidance Parameters
     parser.add_argument("--is_step", action="store_true",
                         help="Enable step-by-step mode. The process will pause after each QA generation, allowing for manual review and preference setting (like/dislike).")
@@ -83,6 +90,48 @@ def qa_generation_args(parser: argparse.ArgumentParser):
                         help='Enable the second stage SQL validation process.')
     parser.add_argument('--domain', type=str,
                         help='Domain of the dataset.(financial,medical)')
+    parser.add_argument('--max_concurrency', type=int, default=8,
+                        help='Maximum number of concurrent LLM requests for QA generation. Only used when --is_step is not set.')
+    parser.add_argument('--request_timeout', type=float, default=None,
+                        help='Timeout in seconds for each QA generation request (for streamed responses, the longest wait between chunks). Timed-out requests are retried with backoff. Default: the SDK default (10 minutes).')
+    parser.add_argument('--qpm', type=int, default=0,
+                        help='Maximum LLM requests per minute during QA generation (0 = unlimited).')
+    parser.add_argument('--tpm', type=int, default=0,
+                        help='Maximum LLM tokens per minute during QA generation (0 = unlimited).')
+    parser.add_argument('--use_prompt_cache_key', action='store_true',
+                        help='Send a per (conversation, difficulty) prompt_cache_key so requests sharing a prompt prefix hit the provider prompt cache.')
+    parser.add_argument('--save_every', type=int, default=10,
+                        help='Save the QA cache once N QAs have changed since the last save, or 30 seconds have passed (step-by-step mode always saves immediately).')
+    parser.add_argument('--use_batch_api', action='store_true',
+                        help='Generate QAs through the provider Batch API (cheaper, results within 24h). Only used when --is_step is not set; failed requests are regenerated in real time.')
+    parser.add_argument('--batch_poll_interval', type=float, default=60.0,
+                        help='Seconds between Batch API status checks.')
+    parser.add_argument('--render_workers', type=int, default=0,
+                        help='Worker processes for rendering large tabular session contexts in parallel (0 = render in the calling thread).')
+    parser.add_argument('--disable_thinking', action='store_true',
+                        help='Disable model thinking for QA generation and use non-streaming requests.')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='Seed for session sampling. With a seed, the sessions chosen for each (conversation, difficulty, slot) are the same across runs.')
+    parser.add_argument('--num_workers', type=int, default=1,
+                        help='Number of processes generating QAs for disjoint sets of conversations. Concurrency and rate limits are split between them. Only used when --is_step and --use_batch_api are not set.')
+    parser.add_argument('--use_response_cache', action='store_true',
+                        help='Cache LLM responses on disk by exact request and reuse them on later runs (each cached response is used at most once per run). Most useful together with --seed.')
+    parser.add_argument('--table_type_in_header', action='store_true',
+                        help='Medical domain: state each table\'s table_type once in its header line instead of repeating it on every row (fewer prompt tokens).')
+    parser.add_argument('--response_cache_match', type=str, default='exact', choices=['exact', 'context'],
+                        help='How --use_response_cache matches requests: "exact" needs the whole request to match; "context" ignores the sampled liked/disliked examples and matches on template, selected sessions and request parameters.')
+    parser.add_argument('--context_last', action='store_true',
+                        help='Put the session context at the end of the QA generation prompt, after the rules and output format, so requests of the same difficulty share a longer prefix for server-side prompt caching.')
+    parser.add_argument('--samples_per_request', type=int, default=1,
+                        help='Number of responses sampled per QA generation request (the API "n" parameter). QAs still needed for the same conversation and difficulty share one request and one prompt prefill. 0 = choose per conversation and difficulty: as few requests as possible (at most 4 samples each) with evenly split sample counts. Not used with --is_step; forced to 1 with --temperature 0.')
+    parser.add_argument('--append_cache_log', action='store_true',
+                        help='Append each QA cache change to qa_cache.log.jsonl instead of periodically rewriting qa_cache.json; the cache file is rewritten (and the log cleared) every 1000 changes and at the end. Not used with --is_step.')
+    parser.add_argument('--cache_format', type=str, default='json', choices=['json', 'jsonl'],
+                        help='On-disk format of the QA cache: "json" (qa_cache.json, indented) or "jsonl" (qa_cache.jsonl, one QA per line, faster to write). An existing qa_cache.json is read once and rewritten as JSON Lines.')
+    parser.add_argument('--validate_workers', type=int, default=1,
+                        help='Number of threads validating QAs with SQL. Each thread uses its own in-memory SQLite database; QAs over the same sessions stay on one thread.')
+    parser.add_argument('--temperature', type=float, default=None,
+                        help='Sampling temperature for QA generation (default: server default). With 0, identical requests that are in flight at the same time are sent only once.')
     # parser.add_argument('--semantic_similarity_threshold', type=float, default=0.8,
     #                     help='Cosine similarity threshold for marking a newly generated question as a semantic duplicate of an existing one. Range: 0.0 to 1.0.')
     # parser.add_argument('--embedding_model_name', type=str, default='all-MiniLM-L6-v2',
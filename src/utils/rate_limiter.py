@@ -0,0 +1,121 @@
+# src/utils/rate_limiter.py
+"""
+LLM 请求限流工具
+- RateLimiter: 按滑动窗口限制每分钟请求数（QPM）和 token 数（TPM）
+- AdaptiveConcurrencyLimiter: AIMD 自适应并发控制，遇到限流时减半，持续成功时逐步恢复
+- retry_with_backoff: 对限流和网络错误做指数退避重试
+均可在多个工作线程间共享
+"""
+import time
+import random
+import logging
+import threading
+from collections import deque
+from typing import Callable, Tuple, Type, TypeVar
+
+T = TypeVar("T")
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter:
+    """
+    滑动窗口限流器：任意 window 秒内最多放行 max_per_minute 个请求、
+    消耗 max_tokens_per_minute 个 token。对应上限 <= 0 表示不限制。
+    token 数在请求完成后通过 record_tokens 回填。
+    """
+    def __init__(self, max_per_minute: int = 0, max_tokens_per_minute: int = 0, window: float = 60.0):
+        self.max_per_minute = max_per_minute
+        self.max_tokens_per_minute = max_tokens_per_minute
+        self.window = window
+        self._timestamps = deque()
+        self._token_usage = deque()  # (timestamp, tokens)
+        self._window_tokens = 0
+        self._lock = threading.Lock()
+
+    def _evict(self, now: float):
+        while self._timestamps and now - self._timestamps[0] >= self.window:
+            self._timestamps.popleft()
+        while self._token_usage and now - self._token_usage[0][0] >= self.window:
+            self._window_tokens -= self._token_usage.popleft()[1]
+
+    def acquire(self):
+        """阻塞直到可以发出下一个请求"""
+        if self.max_per_minute <= 0 and self.max_tokens_per_minute <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._evict(now)
+                waits = []
+                if self.max_per_minute > 0 and len(self._timestamps) >= self.max_per_minute:
+                    waits.append(self.window - (now - self._timestamps[0]))
+                if self.max_tokens_per_minute > 0 and self._window_tokens >= self.max_tokens_per_minute:
+                    waits.append(self.window - (now - self._token_usage[0][0]))
+                if not waits:
+                    self._timestamps.append(now)
+                    return
+                wait = max(waits)
+            time.sleep(wait)
+
+    def record_tokens(self, tokens: int):
+        """记录一次请求实际消耗的 token 数（来自 completion.usage）"""
+        if self.max_tokens_per_minute <= 0 or not tokens:
+            return
+        with self._lock:
+            self._token_usage.append((time.monotonic(), tokens))
+            self._window_tokens += tokens
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    AIMD 并发控制：同时进行的请求数不超过当前上限 limit。
+    请求被限流时 limit 乘以 decrease_factor（至少为 1）；
+    连续成功 limit 次后 limit 加 1，直到 max_concurrency。
+    """
+    def __init__(self, max_concurrency: int, decrease_factor: float = 0.5):
+        self.max_concurrency = max(1, max_concurrency)
+        self.decrease_factor = decrease_factor
+        self.limit = self.max_concurrency
+        self._in_flight = 0
+        self._successes = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self._in_flight >= self.limit:
+                self._condition.wait()
+            self._in_flight += 1
+
+    def release(self, rate_limited: bool = False):
+        with self._condition:
+            self._in_flight -= 1
+            if rate_limited:
+                new_limit = max(1, int(self.limit * self.decrease_factor))
+                if new_limit < self.limit:
+                    logger.warning(f"触发限流，并发上限降为 {new_limit}")
+                self.limit = new_limit
+                self._successes = 0
+            else:
+                self._successes += 1
+                if self._successes >= self.limit and self.limit < self.max_concurrency:
+                    self.limit += 1
+                    self._successes = 0
+            self._condition.notify_all()
+
+
+def retry_with_backoff(func: Callable[[], T],
+                       retry_on: Tuple[Type[BaseException], ...],
+                       max_attempts: int = 5,
+                       initial_wait: float = 1.0,
+                       max_wait: float = 30.0) -> T:
+    """调用 func，遇到 retry_on 中的异常时按带抖动的指数退避重试，超过次数后抛出最后一次异常"""
+    for attempt in range(1, max_attempts + 1):
+        try:
+            return func()
+        except retry_on as e:
+            if attempt == max_attempts:
+                raise
+            wait = min(max_wait, initial_wait * 2 ** (attempt - 1)) + random.uniform(0, initial_wait)
+            logger.warning(f"请求失败（第 {attempt}/{max_attempts} 次）：{e}，{wait:.1f} 秒后重试")
+            time.sleep(wait)
@@ -13,6 +13,9 @@ from utils.cache_manager import DialogCacheManager
 
 logger = logging.getLogger(__name__)
 
+# LLM 回复中证据块的匹配模式，模块加载时编译一次
+_EVIDENCE_BLOCK_RE = re.compile(r"EVIDENCES_USED_IN_THIS_TURN:\s*\r?\n(.*?)(?=\r?\n---|$)", re.DOTALL)
+
 class SessionSimulator:
     def __init__(self,
                  model: str,
@@ -205,10 +208,12 @@ class SessionSimulator:
                 stream=True,
                 extra_body={"enable_thinking": True}
             )
-            response_content = ""
+            # 分片先收集到列表，最后一次性拼接，避免字符串反复 += 的二次复制
+            parts = []
             for chunk in completion:
-                if chunk.choices[0].delta.content:
-                    response_content += chunk.choices[0].delta.content
+                if chunk.choices and chunk.choices[0].delta.content:
+                    parts.append(chunk.choices[0].delta.content)
+            response_content = "".join(parts)
             logger.debug(f"API response: {response_content}")
             return response_content
         except Exception as e:
@@ -235,8 +240,7 @@ class SessionSimulator:
         """
         清理对话内容 + 把 LLM 标记的证据解析成 Evidence 元组
         """
-        pattern = r"EVIDENCES_USED_IN_THIS_TURN:\s*\r?\n(.*?)(?=\r?\n---|$)"
-        match = re.search(pattern, raw, re.DOTALL)
+        match = _EVIDENCE_BLOCK_RE.search(raw)
     
         content = raw
         evidences: List[Tuple] = []
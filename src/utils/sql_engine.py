@@ -4,22 +4,26 @@ import logging
 from .data_struct import Table
 
 class SqlEngine:
-    def __init__(self, db_name: str = ":memory:"):
-        self.conn = sqlite3.connect(db_name)
+    def __init__(self, db_name: str = ":memory:", check_same_thread: bool = True):
+        self.conn = sqlite3.connect(db_name, check_same_thread=check_same_thread)
         self.conn.row_factory = sqlite3.Row
+        if db_name == ":memory:":
+            # 临时内存库不需要持久化保证，关闭日志落盘和同步
+            self.conn.execute("PRAGMA journal_mode=MEMORY")
+            self.conn.execute("PRAGMA synchronous=OFF")
         self.logger = logging.getLogger(self.__class__.__name__)
 
-    def create_table_from_struct(self, tables: List[Dict], domain: str = "financial"):
+    def create_table_from_struct(self, tables: List[Dict], domain: str = "financial", table_name: str = "unified_data"):
         """
-        根据领域创建统一格式的表
+        根据领域创建统一格式的表，默认表名为 unified_data
         """
         cur = self.conn.cursor()
-        cur.execute("DROP TABLE IF EXISTS unified_data")
-        self.logger.info("Dropped existing unified_data table")
+        cur.execute(f"DROP TABLE IF EXISTS {table_name}")
+        self.logger.info(f"Dropped existing {table_name} table")
         # 创建统一表结构
         if domain == "financial":
             create_sql = """
-            CREATE TABLE unified_data (
+            CREATE TABLE {table_name} (
                 code TEXT,
                 sname TEXT,
                 tdate TEXT,
@@ -29,7 +33,7 @@ class SqlEngine:
             """
         elif domain == "medical":
             create_sql = """
-            CREATE TABLE unified_data (
+            CREATE TABLE {table_name} (
                 PatientID TEXT,
                 time_event TEXT,
                 variable_name TEXT,
@@ -41,7 +45,7 @@ class SqlEngine:
             self.logger.error(f"Unsupported domain: {domain}")
             raise ValueError(f"Unsupported domain: {domain}")
         
-        cur.execute(create_sql)
+        cur.execute(create_sql.format(table_name=table_name))
         self.logger.info(f"Created unified table for domain: {domain}")
         
         # 插入数据
@@ -68,11 +72,27 @@ class SqlEngine:
                     ))
         
         cur.executemany(
-            "INSERT INTO unified_data VALUES (?, ?, ?, ?, ?)",
+            f"INSERT INTO {table_name} VALUES (?, ?, ?, ?, ?)",
             insert_data
         )
         self.conn.commit()
-        self.logger.info(f"Inserted {len(insert_data)} rows into unified_data")
+        self.logger.info(f"Inserted {len(insert_data)} rows into {table_name}")
+
+    def use_table(self, table_name: str):
+        """
+        将临时视图 unified_data 指向已建好的表，查询语句中的表名无需改写
+        """
+        cur = self.conn.cursor()
+        cur.execute("DROP VIEW IF EXISTS temp.unified_data")
+        cur.execute(f"CREATE TEMP VIEW unified_data AS SELECT * FROM {table_name}")
+        self.conn.commit()
+
+    def drop_tables(self, table_names: List[str]):
+        """删除不再使用的表"""
+        cur = self.conn.cursor()
+        for table_name in table_names:
+            cur.execute(f"DROP TABLE IF EXISTS {table_name}")
+        self.conn.commit()
 
     def execute_query(self, query: str) -> List[Dict]:
         """执行SQL查询并返回字典列表"""
@@ -1,8 +1,30 @@
 from typing import Any, List, Dict, Tuple
+from operator import itemgetter
 import logging
 
 logger = logging.getLogger(__name__)
 
+# 各领域用于比较证据的字段，第 4 个字段为数值
+_EVIDENCE_FIELDS = {
+    "financial": ("code", "sname", "tdate", "value", "metric"),
+    "medical": ("patient_id", "timestamp", "variable_name", "value", "table_type"),
+}
+_DEFAULT_EVIDENCE_FIELDS = ("entity_id", "timestamp", "variable_name", "value", "table_type")
+_EVIDENCE_GETTERS = {
+    fields: itemgetter(*fields)
+    for fields in (*_EVIDENCE_FIELDS.values(), _DEFAULT_EVIDENCE_FIELDS)
+}
+
+
+def _evidence_key(item: Dict, fields: Tuple[str, ...]) -> Tuple:
+    """将一条证据转换为可比较的元组；字段齐全时用 itemgetter 一次取出，缺字段时按默认值补齐"""
+    try:
+        a, b, c, value, d = _EVIDENCE_GETTERS[fields](item)
+    except KeyError:
+        a, b, c, value, d = (item.get(f, 0 if f == "value" else "") for f in fields)
+    return (a, b, c, round(float(value), 5), d)
+
+
 class Validator:
     """答案与证据验证器"""
     
@@ -27,59 +49,8 @@ class Validator:
             return False
         
         # 转换证据为可比较的格式
-        llm_set = set()
-        sql_set = set()
-        
-        if domain == "financial":
-            for item in llm_evidence:
-                llm_set.add((
-                    item.get("code", ""),
-                    item.get("sname", ""),
-                    item.get("tdate", ""),
-                    round(float(item.get("value", 0)), 5),
-                    item.get("metric", "")
-                ))
-            for item in sql_evidence:
-                sql_set.add((
-                    item.get("code", ""),
-                    item.get("sname", ""),
-                    item.get("tdate", ""),
-                    round(float(item.get("value", 0)), 5),
-                    item.get("metric", "")
-                ))
-        elif domain == "medical":
-            for item in llm_evidence:
-                llm_set.add((
-                    item.get("patient_id", ""),
-                    item.get("timestamp", ""),
-                    item.get("variable_name", ""),
-                    round(float(item.get("value", 0)), 5),
-                    item.get("table_type", "")
-                ))
-            for item in sql_evidence:
-                sql_set.add((
-                    item.get("patient_id", ""),
-                    item.get("timestamp", ""),
-                    item.get("variable_name", ""),
-                    round(float(item.get("value", 0)), 5),
-                    item.get("table_type", "")
-                ))
-        else:
-            for item in llm_evidence:
-                llm_set.add((
-                    item.get("entity_id", ""),
-                    item.get("timestamp", ""),
-                    item.get("variable_name", ""),
-                    round(float(item.get("value", 0)), 5),
-                    item.get("table_type", "")
-                ))
-            for item in sql_evidence:
-                sql_set.add((
-                    item.get("entity_id", ""),
-                    item.get("timestamp", ""),
-                    item.get("variable_name", ""),
-                    round(float(item.get("value", 0)), 5),
-                    item.get("table_type", "")
-                ))
+        fields = _EVIDENCE_FIELDS.get(domain, _DEFAULT_EVIDENCE_FIELDS)
+        llm_set = {_evidence_key(item, fields) for item in llm_evidence}
+        sql_set = {_evidence_key(item, fields) for item in sql_evidence}
         
-        return llm_set == sql_set
\ No newline at end of file
+        return llm_set == sql_set
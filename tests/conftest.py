@@ -0,0 +1,7 @@
+import os
+import sys
+
+# 与 scripts/run_qa_generation.sh 一致，以 src 为导入根目录
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+# 导入 client.llm_client 时需要 API 密钥；测试中的请求都由桩代替，不会真正发出
+os.environ.setdefault("DASHSCOPE_API_KEY", "test")
@@ -0,0 +1,94 @@
+import json
+import os
+import types
+
+import pytest
+
+import pipeline.question_generator as question_generator
+from pipeline.question_generator import QuestionGenerator
+from utils.data_struct import Conversation, ConversationDataset, MultiModalTurn, Session, Table
+from utils.json_utils import iter_json_records
+
+
+class _StubCompletions:
+    """按请求返回固定格式QA回复的 chat.completions 桩（非流式）"""
+    def __init__(self, fail: bool = False):
+        self.fail = fail
+        self.count = 0
+
+    def create(self, model, messages, stream=False, n=None, **kwargs):
+        if self.fail:
+            raise AssertionError("unexpected LLM call")
+        choices = []
+        for index in range(n or 1):
+            self.count += 1
+            body = {
+                "question": f"Q{os.getpid()}-{self.count}: what is the average Na value?",
+                "answer": "4.5",
+                "evidence": [["1", "2020-01-01 00:00:00", "Na", 4.5, "ChemistryEvents"]],
+                "sql_answer_query": "SELECT AVG(value) FROM unified_data",
+                "sql_evidence_query": "SELECT * FROM unified_data",
+            }
+            message = types.SimpleNamespace(content="```json\n" + json.dumps(body) + "\n```")
+            choices.append(types.SimpleNamespace(message=message, index=index))
+        return types.SimpleNamespace(choices=choices, usage=None)
+
+
+class _StubClient:
+    def __init__(self, fail: bool = False):
+        self.chat = types.SimpleNamespace(completions=_StubCompletions(fail))
+
+    def with_options(self, **kwargs):
+        return self
+
+
+def _make_dataset(num_conversations: int = 2, num_sessions: int = 4) -> ConversationDataset:
+    conversations = []
+    for c in range(1, num_conversations + 1):
+        sessions = []
+        for s in range(1, num_sessions + 1):
+            time_event = f"2020-01-0{s} 0{c}:00:00"
+            table = Table(headers=["PatientID", "time_event", "variable_name", "value"],
+                          rows=[{"PatientID": c, "time_event": time_event, "variable_name": "Na", "value": 4.0 + s}],
+                          table_type="ChemistryEvents")
+            sessions.append(Session(
+                session_id=f"patient_{c}_session_{s}",
+                time=f"{time_event} to {time_event}",
+                participants=["User", "Assistant"],
+                turns=[MultiModalTurn(f"patient_{c}_session_{s}_intro", "System", "Session contains 1 medical events")],
+                tables=[table],
+            ))
+        conversations.append(Conversation(f"patient_{c}", ["User", "Assistant"], sessions))
+    return ConversationDataset(conversations)
+
+
+def _make_generator(cache_dir, **kwargs) -> QuestionGenerator:
+    return QuestionGenerator(model="stub", min_sessions=2, max_sessions=3, cache_dir=str(cache_dir),
+                             domain="medical", max_concurrency=2, seed=7, enable_thinking=False,
+                             use_response_cache=True, **kwargs)
+
+
+def test_process_workers_merge_qa_and_response_caches(tmp_path, monkeypatch):
+    # 子进程通过 fork 继承替换后的 client
+    monkeypatch.setattr(question_generator, "client", _StubClient())
+    dataset = _make_dataset()
+    difficulty_counts = {"easy": 2, "medium": 0, "hard": 0}
+
+    generator = _make_generator(tmp_path, num_workers=2)
+    generator.batch_generate(dataset, difficulty_counts)
+
+    assert not [name for name in os.listdir(tmp_path) if name.startswith("worker_")]
+    qas = generator.cache_manager.get_all_qas()
+    assert len(qas) == 4
+    assert {qa["conversation_id"] for qa in qas} == {"patient_1", "patient_2"}
+    responses = list(iter_json_records(str(tmp_path / "llm_responses.jsonl")))
+    assert len(responses) == 4
+
+    # 丢弃QA缓存后重新运行：全部回复都来自合并后的回复缓存，不再调用接口
+    os.remove(generator.cache_manager.current_cache_path)
+    monkeypatch.setattr(question_generator, "client", _StubClient(fail=True))
+    rerun = _make_generator(tmp_path)
+    rerun.batch_generate(dataset, difficulty_counts)
+    assert sorted(qa["question_text"] for qa in rerun.cache_manager.get_all_qas()) == \
+        sorted(qa["question_text"] for qa in qas)
+    assert len(list(iter_json_records(str(tmp_path / "llm_responses.jsonl")))) == 4